@@ -17,7 +17,17 @@ import matplotlib.pyplot as plt
 import numpy as np
 import math
 import scipy.special as sps
+import scipy.optimize as spo
+import time
 import warnings
+import hashlib
+import tempfile
+import weakref
+from collections import OrderedDict
+
+# for running timesteps in parallel
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 warnings.filterwarnings("ignore")
 
 # for testing Theis solution within polygon
@@ -25,12 +35,16 @@ import shapely
 
 # importing a bunch of gis-related environments just for visibility of options
 import matplotlib.patches as mpatches
+import matplotlib.collections as mcollections
+import matplotlib.colors as mcolors
+import matplotlib.transforms as mtransforms
 
 # for gifs
 import imageio
 
 # for plotting
 import cartopy.crs as ccrs
+import cartopy.io.img_tiles as cimgt
 
 #%% BEHOLD: THE CONVERSION FACTORS
 ft2m = 0.304800609601219
@@ -47,25 +61,307 @@ def find_cells_within_polygon( polygon, gridx, gridy ):
     # create a boolean array of 'False' values (i.e., 0)
     pts_in = np.zeros( gridx.shape, dtype='bool')
 
+    # classify every cell within the polygon's bounding box at once
+    window, inside = _cells_in_polygon( polygon, gridx, gridy,
+                                        grid_axes( gridx, gridy, strict=False ) )
+    pts_in[window] = inside
+
+    # ensuring points are found.
+    if np.any( pts_in ):
+        return pts_in
+    else:
+        raise Exception('Function did not find any cells within polygon.')
+#===============================
+
+
+
+# cells of the polygon's bounding box (window) and whether the polygon contains
+# each one (inside) -> axes (from grid_axes) let the window be a slice
+def _cells_in_polygon( polygon, gridx, gridy, axes=None ):
     # get bounds of polygon <- [west, south, east, North]
     bbox = polygon.bounds
+    if axes is not None:
+        cols = np.flatnonzero( (axes[0] >= bbox[0]) & (axes[0] <= bbox[2]) )
+        rows = np.flatnonzero( (axes[1] >= bbox[1]) & (axes[1] <= bbox[3]) )
+        if cols.size == 0 or rows.size == 0:
+            window = ( slice(0, 0), slice(0, 0) )
+        else:
+            window = ( slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1) )
+    else:
+        window = np.where( (gridx >= bbox[0]) & (gridx <= bbox[2]) & \
+                           (gridy >= bbox[1]) & (gridy <= bbox[3]) )
+    xs = np.asarray( gridx[window], dtype=float )
+    ys = np.asarray( gridy[window], dtype=float )
+
+    # check if polygon contains points -> boolean (prepared geometry, shapely 2)
+    if hasattr( shapely, 'contains_xy' ):
+        shapely.prepare( polygon )
+        inside = shapely.contains_xy( polygon, xs, ys )
+    # older shapely -> even-odd edge crossings over the NumPy grid
+    else:
+        inside = _points_in_polygon( polygon, xs, ys )
+    return window, inside
+#===============================
+
+
+
+# even-odd (edge-crossing) test of points against a (multi)polygon's rings
+# -> cells exactly on an edge may differ from polygon.contains
+def _points_in_polygon( polygon, xs, ys ):
+    inside = np.zeros( np.shape( xs ), dtype=bool )
+    for part in getattr( polygon, 'geoms', [polygon] ):
+        part_in = np.zeros( np.shape( xs ), dtype=bool )
+        for ring in [part.exterior] + list( part.interiors ):
+            xy = np.asarray( ring.coords )
+            x0, y0 = xy[:-1,0], xy[:-1,1]
+            x1, y1 = xy[1:,0],  xy[1:,1]
+            # toggle for every edge crossed by a ray cast toward +x
+            for xa, ya, xb, yb in zip( x0, y0, x1, y1 ):
+                if ya == yb:
+                    continue
+                crosses = ( (ya > ys) != (yb > ys) ) & \
+                          ( xs < xa + (ys - ya)*(xb - xa)/(yb - ya) )
+                part_in ^= crosses
+        inside |= part_in
+    return inside
+#===============================
+
+
+
+# the original cell-by-cell version (kept for the benchmark below)
+def _find_cells_within_polygon_loop( polygon, gridx, gridy ):
+    pts_in = np.zeros( gridx.shape, dtype='bool')
+    bbox = polygon.bounds
     bbox_idx = np.where( (gridx >= bbox[0]) & (gridx <= bbox[2]) & \
                          (gridy >= bbox[1]) & (gridy <= bbox[3]) )
-
     for rowi, coli in zip( bbox_idx[0], bbox_idx[1] ):
-        # check if polygon contains point -> boolean
-        bool_val = polygon.contains(
-                shapely.geometry.Point(gridx[rowi,coli],
-                                       gridy[rowi,coli]) )
-        if bool_val: # if true:
-            # store True value
-            pts_in[rowi, coli] = bool_val
+        pts_in[rowi, coli] = polygon.contains(
+                shapely.geometry.Point(gridx[rowi,coli], gridy[rowi,coli]) )
+    return pts_in
+#===============================
 
-    # ensuring points are found.
-    if np.any( pts_in ):
+
+
+# time the vectorized and cell-by-cell versions on a large, irregular polygon
+def benchmark_find_cells_within_polygon( n_cells=400, radius=1000.0, repeats=3 ):
+    import shapely.geometry
+    # star-shaped parcel with a hole, on a square grid covering its bounds
+    angle = np.linspace( 0, 2*np.pi, 73 )[:-1]
+    rad   = radius*( 0.75 + 0.25*np.cos( 7*angle ) )
+    polygon = shapely.geometry.Polygon(
+            np.c_[ rad*np.cos( angle ), rad*np.sin( angle ) ],
+            holes=[ 0.2*radius*np.c_[ np.cos( angle ), np.sin( angle ) ] ] )
+    gridx, gridy = np.meshgrid( np.linspace( -radius, radius, n_cells ),
+                                np.linspace( radius, -radius, n_cells ) )
+
+    # time each version (best of the repeats)
+    timing = {}
+    for name, func in [ ('vectorized', find_cells_within_polygon),
+                        ('loop', _find_cells_within_polygon_loop) ]:
+        best = np.inf
+        for _ in range( repeats if name == 'vectorized' else 1 ):
+            start = time.perf_counter()
+            mask  = func( polygon, gridx, gridy )
+            best  = min( best, time.perf_counter() - start )
+        timing[name] = ( best, mask )
+    same = np.array_equal( timing['vectorized'][1], timing['loop'][1] )
+
+    # update user
+    print( ('Polygon rasterization benchmark: {:,} cells\n'+
+            '  loop:       {:.4f} s\n'+
+            '  vectorized: {:.4f} s ({:.1f}x speedup)\n'+
+            '  identical masks: {}\n').format(
+                    n_cells**2, timing['loop'][0], timing['vectorized'][0],
+                    timing['loop'][0]/timing['vectorized'][0], same ) )
+
+    return { 'loop_sec': timing['loop'][0],
+             'vectorized_sec': timing['vectorized'][0], 'identical': same }
+
+
+
+#%% RASTERIZE THE WHOLE POLYGON LAYER IN ONE PASS
+
+# cells of every polygon -> integer label grid (polygon id per cell, -1 for
+# none) and per-polygon flat cell indices (cell_index[offsets[i]:offsets[i+1]])
+class PolygonCells:
+
+    # initialization function for class
+    def __init__( self, labels, cell_index, offsets ):
+        self.labels     = labels
+        self.cell_index = cell_index
+        self.offsets    = offsets
+        self.n_polygons = offsets.size - 1
+        self.counts     = np.diff( offsets )
+
+    # flat cell indices of polygon idx
+    def cells( self, idx ):
+        return self.cell_index[ self.offsets[idx]:self.offsets[idx+1] ]
+
+    # boolean mask of polygon idx (as from find_cells_within_polygon)
+    def mask( self, idx ):
+        pts_in = np.zeros( self.labels.shape, dtype='bool' )
+        pts_in.reshape(-1)[ self.cells( idx ) ] = True
         return pts_in
+
+    # polygon id of every entry in cell_index
+    def group_ids( self ):
+        return np.repeat( np.arange( self.n_polygons ), self.counts )
+
+    # values of a grid at every polygon's cells, grouped by polygon
+    def gather( self, grid ):
+        return np.asarray( grid ).reshape(-1)[ self.cell_index ]
+
+    # grouped reduction (np.add, np.maximum, ...) of a grid over each polygon
+    # -> NaN for polygons without cells
+    def reduce( self, grid, ufunc=np.add ):
+        out = np.full( self.n_polygons, np.nan )
+        has = self.counts > 0
+        if np.any( has ):
+            out[has] = ufunc.reduceat( self.gather( grid ),
+                                       self.offsets[:-1][has] )
+        return out
+
+    def __len__( self ):
+        return self.n_polygons
+#===============================
+
+
+
+# rasterize every polygon (rows of polygon_df, or a list of geometries) in one
+# pass over the grid; each polygon only visits the cells of its bounding box
+# -> overlap: 'first' (lowest polygon id) or 'last' labels the shared cells;
+#    the per-polygon cell lists always hold every cell of each polygon
+def polygon_label_raster( polygon_df, gridx, gridy, overlap='first',
+                          require_cells=True ):
+    if overlap not in ('first', 'last'):
+        raise Exception( 'Overlap rule "{}" is not "first" or "last".'.format(
+                         overlap ) )
+    if hasattr( polygon_df, 'loc' ):
+        geometries = list( polygon_df.loc[:,'geometry'] )
     else:
-        raise Exception('Function did not find any cells within polygon.')
+        geometries = list( polygon_df )
+    grid_shape = np.shape( gridx )
+    axes = grid_axes( gridx, gridy, strict=False )
+
+    # cell lists of every polygon
+    lists = []
+    for idx in range( len(geometries) ):
+        window, inside = _cells_in_polygon( geometries[idx], gridx, gridy, axes )
+        # flat indices of the contained cells
+        if axes is not None:
+            rows, cols = np.nonzero( inside.reshape(
+                            window[0].stop - window[0].start,
+                            window[1].stop - window[1].start ) )
+            flat = ( rows + window[0].start )*grid_shape[1] + \
+                   ( cols + window[1].start )
+        else:
+            flat = np.ravel_multi_index( window, grid_shape )[inside]
+        if require_cells and flat.size == 0:
+            raise Exception( ('Function did not find any cells within polygon '+
+                              '{}.').format( idx ) )
+        lists.append( np.sort( flat ) )
+
+    offsets = np.zeros( len(lists) + 1, dtype=np.int64 )
+    offsets[1:] = np.cumsum( [ cells.size for cells in lists ] )
+    cell_index = np.concatenate( lists ) if lists else np.zeros( 0, dtype=np.int64 )
+    cell_index = cell_index.astype( np.int64 )
+    labels = _label_grid( grid_shape, cell_index, offsets, overlap )
+    return PolygonCells( labels, cell_index, offsets )
+#===============================
+
+
+
+# label grid from the per-polygon cell lists and the overlap rule
+def _label_grid( grid_shape, cell_index, offsets, overlap='first' ):
+    labels = np.full( grid_shape, -1, dtype=np.int32 ).reshape(-1)
+    n_polygons = offsets.size - 1
+    # 'first' -> write in reverse so the lowest polygon id is written last
+    order = range( n_polygons - 1, -1, -1 ) if overlap == 'first' \
+            else range( n_polygons )
+    for idx in order:
+        labels[ cell_index[offsets[idx]:offsets[idx+1]] ] = idx
+    return labels.reshape( grid_shape )
+
+
+
+#%% PERSISTENT ON-DISK CACHE OF THE POLYGON CELLS
+
+# version of the cache file layout (part of the key)
+_POLYGON_CACHE_VERSION = 1
+
+# hash of the polygon geometries, the grid definition, and the overlap rule
+def polygon_cells_key( polygon_df, gridx, gridy, overlap='first' ):
+    if hasattr( polygon_df, 'loc' ):
+        geometries = list( polygon_df.loc[:,'geometry'] )
+    else:
+        geometries = list( polygon_df )
+    hasher = hashlib.sha1( '{}|{}|{}'.format( _POLYGON_CACHE_VERSION, overlap,
+                                              len(geometries) ).encode() )
+    for geom in geometries:
+        hasher.update( geom.wkb )
+    # rectilinear grids are defined by their axes, any other by every cell
+    axes = grid_axes( gridx, gridy, strict=False )
+    hasher.update( str( np.shape( gridx ) ).encode() )
+    for arr in ( axes if axes is not None else ( gridx, gridy ) ):
+        hasher.update( np.ascontiguousarray( arr, dtype=float ).tobytes() )
+    return hasher.hexdigest()
+#===============================
+
+
+
+# write arrays to a .npz file through a temporary file in the same folder, so
+# an interrupted write never leaves a partial file under filename
+def _save_npz_atomic( filename, compressed=False, **arrays ):
+    folder = os.path.dirname( os.path.abspath( filename ) )
+    os.makedirs( folder, exist_ok=True )
+    fd, tmp_file = tempfile.mkstemp( suffix='.tmp', dir=folder )
+    try:
+        with os.fdopen( fd, 'wb' ) as fid:
+            if compressed:
+                np.savez_compressed( fid, **arrays )
+            else:
+                np.savez( fid, **arrays )
+        os.replace( tmp_file, filename )
+    except BaseException:
+        _remove_quietly( tmp_file )
+        raise
+#===============================
+
+
+
+# polygon cells (PolygonCells) from the cache in cache_dir, rasterizing and
+# storing them (compressed index arrays) when the polygons or grid changed
+# -> unreadable or incomplete cache files are rebuilt
+def load_polygon_cells( polygon_df, gridx, gridy, cache_dir, overlap='first',
+                        require_cells=True ):
+    key = polygon_cells_key( polygon_df, gridx, gridy, overlap )
+    cache_file = os.path.join( cache_dir, 'polygon_cells_{}.npz'.format( key ) )
+
+    # reload from a previous run (any load error -> rebuild)
+    if os.path.isfile( cache_file ):
+        try:
+            with np.load( cache_file ) as cached:
+                if str( cached['key'] ) == key:
+                    offsets    = cached['offsets'].astype( np.int64 )
+                    # cell indices are stored as differences -> cumulative sum
+                    cell_index = np.cumsum( cached['cell_delta'], dtype=np.int64 )
+                    grid_shape = tuple( cached['grid_shape'] )
+                    labels = _label_grid( grid_shape, cell_index, offsets,
+                                          overlap )
+                    return PolygonCells( labels, cell_index, offsets )
+        except Exception:
+            pass
+
+    # rasterize and store
+    poly_cells = polygon_label_raster( polygon_df, gridx, gridy, overlap=overlap,
+                                       require_cells=require_cells )
+    index_dtype = np.int32 if poly_cells.labels.size < 2**31 else np.int64
+    _save_npz_atomic( cache_file, compressed=True, key=np.asarray( key ),
+                      grid_shape=np.asarray( poly_cells.labels.shape ),
+                      offsets=poly_cells.offsets,
+                      cell_delta=np.diff( poly_cells.cell_index,
+                                          prepend=0 ).astype( index_dtype ) )
+    return poly_cells
 
 
 
@@ -185,6 +481,270 @@ def riskType_threshold( polygon, poly_idx, water_table, grd_surface,
 
 
 
+#%% BATCHED THRESHOLD EXCEEDENCE FOR ALL POLYGONS
+
+# risk codes (the 'PlotColors' values set by riskType_threshold)
+RISK_NONE           = -1
+RISK_SURFACE        = 0
+RISK_BASEMENT       = 1
+RISK_INFRASTRUCTURE = 2
+
+# per-polygon cells as PolygonCells from a PolygonCells or a list of boolean
+# masks / flat index arrays / np.where tuples (one per polygon)
+def as_polygon_cells( poly_cells, grid_shape ):
+    if isinstance( poly_cells, PolygonCells ):
+        return poly_cells
+    lists = []
+    for cells in poly_cells:
+        if isinstance( cells, tuple ):
+            flat = np.ravel_multi_index( cells, grid_shape )
+        else:
+            cells = np.asarray( cells )
+            flat = np.flatnonzero( cells ) if cells.dtype == bool \
+                   else cells.reshape(-1)
+        lists.append( np.sort( flat ).astype( np.int64 ) )
+    offsets = np.zeros( len(lists) + 1, dtype=np.int64 )
+    offsets[1:] = np.cumsum( [ cells.size for cells in lists ] )
+    cell_index = np.concatenate( lists ) if lists else np.zeros( 0, dtype=np.int64 )
+    return PolygonCells( _label_grid( grid_shape, cell_index, offsets ),
+                         cell_index, offsets )
+#===============================
+
+
+
+# percentile (numpy's 'linear' method) of each group of values, where group i
+# is values[offsets[i]:offsets[i+1]] and q holds one percentile per group
+# -> same values as np.percentile( group, q[i] ) with a python int/float q;
+#    NaN for empty groups and groups holding a NaN
+def grouped_percentile( values, offsets, q ):
+    values  = np.asarray( values )
+    offsets = np.asarray( offsets, dtype=np.int64 )
+    counts  = np.diff( offsets )
+    out = np.full( counts.size, np.nan, dtype=np.result_type( values, np.float16 ) )
+    has = counts > 0
+    if not np.any( has ):
+        return out
+
+    # sort the values within each group (NaN last)
+    group = np.repeat( np.arange( counts.size ), counts )
+    srt = values[ np.lexsort( ( values, group ) ) ]
+    start = offsets[:-1][has]
+    n = counts[has]
+
+    # virtual index (n-1)*q and its neighbours
+    virtual = ( n - 1 ) * np.true_divide( np.broadcast_to( q, counts.shape )[has],
+                                          100 )
+    prev  = np.floor( virtual )
+    gamma = virtual - prev
+    above = virtual >= n - 1
+    prev  = np.where( above, n - 1, prev ).astype( np.int64 )
+    nxt   = np.where( above, n - 1, prev + 1 )
+    gamma[above] = 1.0
+
+    # linear interpolation (as np.percentile does it, in the values' dtype)
+    below_val = srt[ start + prev ]
+    above_val = srt[ start + nxt ]
+    diff = above_val - below_val
+    res = below_val + diff*gamma.astype( out.dtype )
+    upper = gamma >= 0.5
+    res[upper] = ( above_val - diff*( 1 - gamma ).astype( out.dtype ) )[upper]
+
+    # groups holding a NaN (sorted to the end of the group)
+    res[ np.isnan( srt[ start + n - 1 ] ) ] = np.nan
+    out[has] = res
+    return out
+#===============================
+
+
+
+# static part of the risk classification, built once per polygon set and DEM:
+# each polygon's percentile and the ground surface, basement (GS - 5 ft), and
+# infrastructure elevations (NaN where the level does not apply to the polygon)
+# -> poly_cells: PolygonCells, or a list of boolean masks / index arrays
+def risk_threshold_table( polygon_df, poly_cells, grd_surface,
+                          percent_threshold=25, area='Venice', esl_sites=[] ):
+    poly_cells = as_polygon_cells( poly_cells, np.shape( grd_surface ) )
+    n_polygons = len( poly_cells )
+    risk_type  = np.asarray( polygon_df.loc[:,'RiskType'] )
+    if 'UniqueName' in polygon_df.columns:
+        names = np.asarray( polygon_df.loc[:,'UniqueName'], dtype=object )
+    else:
+        names = None
+
+    # unsupported land use -> same error as riskType_threshold
+    known = np.isin( risk_type, [0,1,2,3,4] )
+    if not np.all( known ):
+        raise Exception( ('Error: "RiskType" {} is not currently'+
+                          ' incorporated into analysis.').format(
+                                 risk_type[ np.argmin( known ) ]) )
+
+    # percentile per polygon (Venice roadway and the ESL area sites)
+    q = np.full( n_polygons, percent_threshold, dtype=float )
+    if area=='Venice':
+        q[ risk_type == 3 ] = 5
+    elif names is None:
+        # same error as polygon.loc['UniqueName'] in riskType_threshold
+        raise KeyError( 'UniqueName' )
+    else:
+        q[ np.isin( names, list(esl_sites) ) ] = 2.5
+
+    # pertinent ground surface elevation of each polygon
+    surface = grouped_percentile( poly_cells.gather( grd_surface ),
+                                  poly_cells.offsets, q )
+
+    # assumed basement elevation (residential)
+    basement = np.full_like( surface, np.nan )
+    is_res = risk_type == 1
+    basement[is_res] = surface[is_res] - 5 #feet
+
+    # infrastructure elevation - (dti) depth to infrastructure
+    infrastructure = np.full_like( surface, np.nan )
+    for idx in np.flatnonzero( risk_type == 2 ):
+        if names is not None:
+            dti = determine_infrastructure_depth(
+                        np.asarray( grd_surface ).reshape(-1)[
+                                poly_cells.cells( idx ) ],
+                        polygon_name=names[idx] )
+        else:
+            dti = 0 # fail safe in case this area is compromised accidentally?
+        infrastructure[idx] = surface[idx] - np.asarray( dti, dtype=surface.dtype )
+
+    return { 'poly_cells': poly_cells, 'risk_type': risk_type, 'percent': q,
+             'surface': surface, 'basement': basement,
+             'infrastructure': infrastructure }
+#===============================
+
+
+
+# classify every polygon from the water table and a risk_threshold_table
+# (only the water table percentiles are computed)
+# -> returns an integer array of risk codes (RISK_SURFACE, RISK_BASEMENT,
+#    RISK_INFRASTRUCTURE), with prior (default RISK_NONE) where not at risk
+def classify_risk_table( table, water_table, prior=None ):
+    poly_cells = table['poly_cells']
+    wt_elev = grouped_percentile( poly_cells.gather( water_table ),
+                                  poly_cells.offsets, table['percent'] )
+    return _risk_codes( table, wt_elev, prior )
+#===============================
+
+
+
+# risk codes from the water table percentile of each polygon
+# (NaN thresholds never compare as exceeded)
+def _risk_codes( table, wt_elev, prior=None ):
+    if prior is None:
+        codes = np.full( wt_elev.shape, RISK_NONE, dtype=int )
+    else:
+        codes = np.array( prior, dtype=int )
+    codes[ wt_elev >= table['basement'] ]       = RISK_BASEMENT
+    codes[ wt_elev >= table['infrastructure'] ] = RISK_INFRASTRUCTURE
+    codes[ wt_elev >= table['surface'] ]        = RISK_SURFACE
+    return codes
+#===============================
+
+
+
+# classify every polygon at once from the water table and the ground surface
+# (same rules as riskType_threshold, each percentile computed once)
+# -> poly_cells: PolygonCells, or a list of boolean masks / index arrays
+# -> returns an integer array of risk codes (see classify_risk_table)
+def classify_risk_batch( polygon_df, poly_cells, water_table, grd_surface,
+                         percent_threshold=25, area='Venice', esl_sites=[],
+                         prior=None ):
+    table = risk_threshold_table( polygon_df, poly_cells, grd_surface,
+                                  percent_threshold, area, esl_sites )
+    return classify_risk_table( table, water_table, prior )
+#===============================
+
+
+
+# polygon indices of each risk code (as used by plot_current_conditions)
+# -> flood_indices, infra_indices, bsmnt_indices
+def risk_indices( codes ):
+    codes = np.asarray( codes )
+    return ( np.flatnonzero( codes == RISK_SURFACE ),
+             np.flatnonzero( codes == RISK_INFRASTRUCTURE ),
+             np.flatnonzero( codes == RISK_BASEMENT ) )
+
+
+
+#%% INCREMENTAL RISK RE-EVALUATION
+
+# classify the polygons timestep after timestep, recomputing the water table
+# percentile only for polygons whose cells moved by at least the margin to
+# their nearest threshold since their last evaluation (a percentile moves no
+# more than the largest change of the values it is taken from), so the codes
+# are always those of classify_risk_table
+class IncrementalRiskClassifier:
+
+    # initialization function for class
+    def __init__( self, table, prior=None ):
+        self.table = table
+        self.prior = prior
+        self.reset()
+
+    # forget the previous evaluations (next call evaluates every polygon)
+    def reset( self ):
+        # water table at each polygon's cells (gathered) when last evaluated
+        self.__reference = None
+        self.__wt_elev   = None
+        self.__margin    = None
+        self.evaluated   = 0
+        self.skipped     = 0
+
+    # distance from each polygon's water table percentile to its nearest
+    # threshold, less a few ulps for the rounding of the percentiles
+    def __threshold_margin( self, wt_elev ):
+        wt_elev = wt_elev.astype( float )
+        levels = np.stack( [ self.table[level].astype( float ) for level in
+                             ( 'surface', 'basement', 'infrastructure' ) ] )
+        margin = np.fmin.reduce( np.abs( levels - wt_elev ), axis=0 )
+        scale  = np.fmax.reduce( np.abs( levels ), axis=0 ) + np.abs( wt_elev )
+        return margin - 8*np.finfo( self.__wt_elev.dtype ).eps*scale
+
+    # risk codes of every polygon for the current water table
+    def classify( self, water_table ):
+        poly_cells = self.table['poly_cells']
+        values = poly_cells.gather( water_table )
+
+        # polygons that may have changed class (all of them on the first call)
+        if self.__reference is None:
+            redo = np.ones( len(poly_cells), dtype=bool )
+            self.__reference = values.copy()
+            self.__wt_elev   = np.full( len(poly_cells), np.nan,
+                                        dtype=np.result_type( values, np.float16 ) )
+            self.__margin    = np.full( len(poly_cells), np.nan )
+        else:
+            change = self.__largest_change( values )
+            redo = ~( change < self.__margin )
+
+        # water table percentiles of those polygons only
+        if np.any( redo ):
+            entries = np.repeat( redo, poly_cells.counts )
+            offsets = np.zeros( np.count_nonzero( redo ) + 1, dtype=np.int64 )
+            offsets[1:] = np.cumsum( poly_cells.counts[redo] )
+            self.__wt_elev[redo] = grouped_percentile( values[entries], offsets,
+                                                       self.table['percent'][redo] )
+            self.__reference[entries] = values[entries]
+            self.__margin[redo] = self.__threshold_margin( self.__wt_elev )[redo]
+        self.evaluated += int( np.count_nonzero( redo ) )
+        self.skipped   += int( redo.size - np.count_nonzero( redo ) )
+
+        return _risk_codes( self.table, self.__wt_elev, self.prior )
+
+    # largest change of the water table at each polygon's cells since its
+    # last evaluation (NaN for polygons without cells or with NaN values)
+    def __largest_change( self, values ):
+        poly_cells = self.table['poly_cells']
+        change = np.full( len(poly_cells), np.nan )
+        has = poly_cells.counts > 0
+        if np.any( has ):
+            diff = np.abs( values - self.__reference )
+            change[has] = np.maximum.reduceat( diff, poly_cells.offsets[:-1][has] )
+        return change
+
+
+
 #%% FUNCTION TO WRITE THE GIF 
 
 # function may not be called as a part of the main regional scripts
@@ -195,12 +755,12 @@ def write_gif( pngpath, outpath='', filename='test.gif', frames_per_sec=1 ):
         
     # designate the folders to search
     gif_path        = (outpath + filename)
-    # find the files to write
-    gif_files = [file for file in os.listdir(outpath) if '.png' in file]
-    #loop through files to write to gif -> mode='I" - for multiple images
-    with imageio.get_writer( gif_path,  mode='I', fps=frames_per_sec) as jiffy:
+    # find the files to write (in frame order -> zero-padded frame names)
+    gif_files = sorted( [file for file in os.listdir(outpath) if '.png' in file] )
+    #loop through files to write to gif, one frame in memory at a time
+    with AnimationWriter( gif_path, frames_per_sec=frames_per_sec ) as jiffy:
         for image in gif_files:
-            jiffy.append_data( imageio.imread(outpath+image) )
+            jiffy.append( imageio.imread(outpath+image) )
 
     # may want to eventually use the following command to shrink gif file size
     # from pygifsicle import optimize
@@ -214,6 +774,142 @@ def write_gif( pngpath, outpath='', filename='test.gif', frames_per_sec=1 ):
 
 
 
+#%% STREAMING ANIMATION WRITER
+
+# the frame (RGB) with each risk face colour (RISK_FACE_RGBA) blended over all
+# of it -> palette samples holding every colour an at-risk polygon can take
+def risk_color_blends( frame ):
+    frame = np.asarray( frame, dtype=float )[...,:3]
+    blends = []
+    for rgba in RISK_FACE_RGBA[1:]:
+        blend = ( 1 - rgba[3] )*frame + rgba[3]*255*rgba[:3]
+        blends.append( np.clip( np.round( blend ), 0, 255 ).astype( np.uint8 ) )
+    return blends
+#===============================
+
+
+
+# write the frames (RGB/RGBA arrays, e.g. from FrameRenderer.render) straight to
+# a .gif, .mp4 or .webp file as they are produced, holding a single frame
+# -> GIF: one palette built from palette_frames (default: the first frame and
+#    the first frame blended with each risk colour, so later at-risk polygons
+#    keep their colours) is shared by every frame; each frame may have its own
+#    duration (ms) and only the rectangle that changed from the previous frame
+#    is stored
+# -> MP4/WebP: piped to ffmpeg (imageio-ffmpeg) at frames_per_sec; longer
+#    durations repeat the frame
+class AnimationWriter:
+
+    # initialization function for class
+    def __init__( self, filename, frames_per_sec=1, palette_frames=None, loop=0,
+                  colors=256 ):
+        self.filename       = filename
+        self.frames_per_sec = frames_per_sec
+        self.frame_ms       = 1000.0/frames_per_sec
+        self.loop           = loop
+        self.colors         = colors
+        self.n_frames       = 0
+        self.format         = os.path.splitext( filename )[1].lower().lstrip('.')
+        if self.format not in ( 'gif', 'mp4', 'webp' ):
+            raise Exception( ('Animation format "{}" is not "gif", "mp4", or '+
+                              '"webp".').format( self.format ) )
+        self.__palette = None
+        if palette_frames is not None:
+            self.__palette = self.__build_palette( palette_frames )
+        self.__fp = None
+        self.__video = None
+        self.__previous = None
+
+    # shared palette from sample frames (stacked into one image)
+    def __build_palette( self, frames ):
+        from PIL import Image
+        stack = np.concatenate( [ np.asarray( frame )[...,:3] for frame in frames ],
+                                axis=0 )
+        return Image.fromarray( np.ascontiguousarray( stack, dtype=np.uint8 ) ).quantize(
+                    colors=self.colors, method=Image.Quantize.MEDIANCUT )
+
+    # add a frame (displayed for duration ms; default 1/frames_per_sec)
+    def append( self, frame, duration=None ):
+        frame = np.asarray( frame )
+        # grayscale -> RGB, RGBA -> RGB
+        if frame.ndim == 2:
+            frame = np.repeat( frame[...,np.newaxis], 3, axis=2 )
+        frame = np.ascontiguousarray( frame[...,:3], dtype=np.uint8 )
+        if duration is None:
+            duration = self.frame_ms
+        if self.format == 'gif':
+            self.__append_gif( frame, duration )
+        else:
+            self.__append_video( frame, duration )
+        self.n_frames += 1
+
+    def __append_gif( self, frame, duration ):
+        from PIL import Image, GifImagePlugin
+        if self.__palette is None:
+            self.__palette = self.__build_palette( [ frame ] +
+                                                   risk_color_blends( frame ) )
+        # map the frame onto the shared palette
+        indexed = Image.fromarray( frame ).quantize( palette=self.__palette,
+                                                     dither=Image.Dither.NONE )
+        pixels  = np.asarray( indexed )
+        # header (global palette and loop count) with the first frame
+        offset = (0, 0)
+        if self.__fp is None:
+            self.__fp = open( self.filename, 'wb' )
+            header, _ = GifImagePlugin.getheader( indexed, info={
+                                'loop': self.loop, 'optimize': False,
+                                'duration': duration } )
+            for chunk in header:
+                self.__fp.write( chunk )
+        # later frames -> only the rectangle that changed (at least one pixel),
+        # drawn over the previous frame (disposal 1)
+        else:
+            rows = np.flatnonzero( np.any( pixels != self.__previous, axis=1 ) )
+            cols = np.flatnonzero( np.any( pixels != self.__previous, axis=0 ) )
+            r0, r1 = ( rows[0], rows[-1] + 1 ) if rows.size else ( 0, 1 )
+            c0, c1 = ( cols[0], cols[-1] + 1 ) if cols.size else ( 0, 1 )
+            offset = ( int(c0), int(r0) )
+            indexed = indexed.crop( ( c0, r0, c1, r1 ) )
+        self.__previous = pixels
+        # GIF durations are in 1/100 s
+        for chunk in GifImagePlugin.getdata( indexed, offset, disposal=1,
+                                             duration=max( 10, int( round(
+                                                     duration/10 ) )*10 ) ):
+            self.__fp.write( chunk )
+
+    def __append_video( self, frame, duration ):
+        if self.__video is None:
+            import imageio_ffmpeg
+            if self.format == 'mp4':
+                codec, params, block = 'libx264', [], 2
+            else:
+                codec, params, block = 'libwebp_anim', [ '-loop', str( self.loop ) ], 1
+            self.__video = imageio_ffmpeg.write_frames( self.filename,
+                                    ( frame.shape[1], frame.shape[0] ),
+                                    fps=self.frames_per_sec, codec=codec,
+                                    output_params=params, macro_block_size=block )
+            self.__video.send( None )
+        for _ in range( max( 1, int( round( duration/self.frame_ms ) ) ) ):
+            self.__video.send( frame )
+
+    # finish the file
+    def close( self ):
+        if self.__fp is not None:
+            self.__fp.write( b';' )
+            self.__fp.close()
+            self.__fp = None
+        if self.__video is not None:
+            self.__video.close()
+            self.__video = None
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+
+
 #%% CHECK THAT THE DESIRED FOLDERS HAVE BEEN CREATED
 def check_folders( path, make_um=True ):
     # split path up and check if exists and create necessary paths
@@ -235,12 +931,26 @@ def check_folders( path, make_um=True ):
 
 
 #%% FUNCTION TO PLOT THE RESULTS
+
+# the ISWS Lambert projection of the grid and polygons
+def isws_projection():
+    false_east = 2999994.0 * ft2m # feet to meters?
+    false_north = -50.0 * ft2m # meters -> fudge factor to realign shapefil with basemap.
+    return ccrs.LambertConformal( false_easting=false_east,
+                                  false_northing=false_north,
+                                  central_longitude=-89.50,
+                                  central_latitude=33.00,
+                                  standard_parallels=(33,45) )
+#===============================
+
+
+
 # create function to update the plot within GIF
 def plot_current_conditions( soln_dict, grd_surf_elev_array, grid_x, grid_y,
                              polygon_df, flood_indices, infra_indices,
                              bsmnt_indices, point_df, cur_time, tile_labels,
                              img_bmp, desired_fig_w=20, figsave_file='no', 
-                             zoom=15 ):
+                             zoom=15, risk_codes=None ):
 
 #====== convert ft to meters =====
     # determine extent of plotting
@@ -248,13 +958,7 @@ def plot_current_conditions( soln_dict, grd_surf_elev_array, grid_x, grid_y,
                                  grid_y.min(), grid_y.max() ])
 
     # finalizing the ISWS Lambert projection
-    false_east = 2999994.0 * ft2m # feet to meters?
-    false_north = -50.0 * ft2m # meters -> fudge factor to realign shapefil with basemap.
-    isws_crs = ccrs.LambertConformal( false_easting=false_east,
-                                        false_northing=false_north,
-                                        central_longitude=-89.50,
-                                        central_latitude=33.00,
-                                        standard_parallels=(33,45) )
+    isws_crs = isws_projection()
 #====== convert ft to meters =====
 
     # determining raster scale
@@ -274,70 +978,34 @@ def plot_current_conditions( soln_dict, grd_surf_elev_array, grid_x, grid_y,
     # adding the "google" basemap
     ax.imshow( img_bmp, origin='upper', 
                extent=meters_extent, transform=isws_crs )
-    ax.add_image( tile_labels,  zoom, interpolation = 'spline36' )
+    # (no label tiles -> img_bmp already holds them, see composite_background)
+    if tile_labels is not None:
+        ax.add_image( tile_labels,  zoom, interpolation = 'spline36' )
     
-    # adding the polygon patches to the map
-    for idx in range( len(polygon_df) ):
-        # grab the current polygon information
-        poly2plot = np.asarray( polygon_df.loc[idx,'geometry'].exterior.xy ).T
-        # Next, check if polygon is having issues:
-        # True - color code, False - leave transparent
-
-        # plot surface flooding
-        if (flood_indices.size > 0) and (idx in flood_indices):
-            ax.add_patch( mpatches.Polygon( poly2plot,
-                                    edgecolor='black', linewidth=2,
-                                    facecolor='black', alpha=0.55,
-                                    transform=isws_crs) )
-
-        # plot infrastructure damage
-        elif (infra_indices.size > 0) and (idx in infra_indices):
-            ax.add_patch( mpatches.Polygon( poly2plot,
-                                    edgecolor='black', linewidth=2,
-                                    facecolor='red', alpha=0.55,
-                                    transform=isws_crs) )
-
-        # plot basement flooding
-        elif (bsmnt_indices.size > 0) and (idx in bsmnt_indices):
-            ax.add_patch( mpatches.Polygon( poly2plot,
-                                    edgecolor='black', linewidth=2,
-                                    facecolor='darkorange', alpha=0.55,
-                                    transform=isws_crs) )
-
-        # plot all polygon boundaries
-        ax.add_patch( mpatches.Polygon( poly2plot,
-                                edgecolor='black', linewidth=2,
-                                fill=False,
-                                transform=isws_crs) )
-# end loop through polygons ==============
-        
+    # adding the polygons to the map as two collections: faces color coded by
+    # risk (transparent if no issues) and all polygon boundaries
+    if risk_codes is None:
+        risk_codes = risk_codes_from_indices( len(polygon_df), flood_indices,
+                                              infra_indices, bsmnt_indices )
+    poly_verts = polygon_vertices( polygon_df )
+    ax.add_collection( mcollections.PolyCollection( poly_verts,
+                            facecolors=risk_face_colors( risk_codes ),
+                            edgecolors='none', transform=isws_crs ),
+                       autolim=False )
+    ax.add_collection( mcollections.PolyCollection( poly_verts,
+                            facecolors='none', edgecolors='black',
+                            linewidths=2, transform=isws_crs ),
+                       autolim=False )
+
     # adding the wells (buffer regions) to the plot
-    for idx in range( len(point_df) ):
-        wells2plot = np.asarray( point_df.loc[idx,'buff_geometry'].exterior.xy ).T
-        ax.add_patch( mpatches.Polygon( wells2plot,
-                            edgecolor='red', linewidth=2,
-                            fill=False,
-                            transform=isws_crs) )
-# end loop through well point locations ==============
+    ax.add_collection( mcollections.PolyCollection(
+                            polygon_vertices( point_df, 'buff_geometry' ),
+                            facecolors='none', edgecolors='red',
+                            linewidths=2, transform=isws_crs ),
+                       autolim=False )
 
     # add legend
-    legend_elements = [ mpatches.Patch( facecolor='black',
-                                        edgecolor='black', #alpha = 0.55,
-                                        label='Surface Flooding'),
-                        mpatches.Patch( facecolor='red',
-                                        edgecolor='black',
-                                        label='Infrastructure Damage'),
-                        mpatches.Patch( facecolor='darkorange',
-                                        edgecolor='black',
-                                        label='Basement Flooding') ]
-#    ax.legend( handles=legend_elements,
-#               title='Legend', title_fontsize=18,
-#               bbox_to_anchor= (1.0015, 1, 0.15, 0.0),
-#               frameon=False )
-                        
-    ax.legend( handles=legend_elements, loc=1,
-               title='Legend', title_fontsize=21,
-               fontsize=18, shadow=True )
+    _add_risk_legend( ax )
 
 # will add text manually in Adobe (or something)
 #    # add descriptive text
@@ -362,12 +1030,1248 @@ def plot_current_conditions( soln_dict, grd_surf_elev_array, grid_x, grid_y,
 
 
 
+#%% OFFLINE BASEMAP TILES AND PRE-COMPOSITED BACKGROUND
+
+# folder name of a tile source within the tile cache: class and style plus a
+# hash of where the tiles come from (local tile_dir, or the url of tile
+# (0,0,0) -> the url template), so sources with other urls get other folders
+def tile_source_key( source ):
+    style = getattr( source, 'style', None )
+    key = type( source ).__name__ if not style else \
+          '{}-{}'.format( type( source ).__name__, style )
+    tile_dir = getattr( source, 'tile_dir', None )
+    if tile_dir is not None:
+        origin = os.path.abspath( tile_dir )
+    else:
+        try:
+            origin = source._image_url( (0, 0, 0) )
+        except Exception:
+            origin = getattr( source, 'url', '' )
+    key = '{}-{}'.format( key, hashlib.sha1( str( origin ).encode()
+                                            ).hexdigest()[:12] )
+    return ''.join( char if char.isalnum() or char in '-_' else '_'
+                    for char in key )
+#===============================
+
+
+
+# tiles read from a local folder (tile_dir/zoom/x/y.png) instead of a web
+# service, e.g. a seeded tile cache or test tiles; missing tiles are blank
+class LocalTiles( cimgt.GoogleWTS ):
+
+    # initialization function for class
+    def __init__( self, tile_dir, desired_tile_form='RGBA' ):
+        super().__init__( desired_tile_form=desired_tile_form )
+        self.tile_dir = tile_dir
+
+    def _image_url( self, tile ):
+        x, y, z = tile
+        return os.path.join( self.tile_dir, str(z), str(x), '{}.png'.format(y) )
+
+    def get_image( self, tile ):
+        from PIL import Image
+        tile_file = self._image_url( tile )
+        if os.path.isfile( tile_file ):
+            img = Image.open( tile_file ).convert( self.desired_tile_form )
+        else:
+            img = Image.new( self.desired_tile_form, (256, 256) )
+        return img, self.tileextent( tile ), 'lower'
+#===============================
+
+
+
+# any cartopy web tile source (e.g. the label tiles) with its tiles stored on
+# local disk as cache_dir/source/zoom/x/y.png; each tile is fetched once and
+# offline=True never fetches (tiles missing from the cache raise an Exception)
+class CachedTiles( cimgt.GoogleWTS ):
+
+    # initialization function for class
+    def __init__( self, source, cache_dir, offline=False ):
+        super().__init__( desired_tile_form=source.desired_tile_form )
+        self.source     = source
+        self.offline    = offline
+        self.tile_dir   = os.path.join( cache_dir, tile_source_key( source ) )
+        self.hits       = 0
+        self.fetched    = 0
+
+    def _image_url( self, tile ):
+        return self.source._image_url( tile )
+
+    # cache file of the tile (x, y, zoom)
+    def tile_file( self, tile ):
+        x, y, z = tile
+        return os.path.join( self.tile_dir, str(z), str(x), '{}.png'.format(y) )
+
+    def get_image( self, tile ):
+        from PIL import Image
+        tile_file = self.tile_file( tile )
+        if os.path.isfile( tile_file ):
+            self.hits += 1
+            img = Image.open( tile_file )
+            img.load()
+            if self.desired_tile_form is not None:
+                img = img.convert( self.desired_tile_form )
+        elif self.offline:
+            raise Exception( ('Tile {} of {} is not in the tile cache {} '+
+                              '(offline).').format( tile,
+                              tile_source_key( self.source ), self.tile_dir ) )
+        else:
+            img = self.source.get_image( tile )[0]
+            if not isinstance( img, Image.Image ):
+                img = Image.fromarray( np.asarray( img ) )
+            os.makedirs( os.path.dirname( tile_file ), exist_ok=True )
+            img.save( tile_file )
+            self.fetched += 1
+        return img, self.tileextent( tile ), 'lower'
+
+    # fetch (once) every tile covering the plotting extent (ISWS projection)
+    # at the zoom level -> number of tiles in the cache for that extent
+    def seed( self, grid_x, grid_y, zoom ):
+        from shapely.geometry import box
+        edge = np.linspace( 0, 1, 50 )
+        xs = np.min( grid_x ) + ( np.max( grid_x ) - np.min( grid_x ) )*np.r_[
+                edge, np.ones_like( edge ), edge[::-1], np.zeros_like( edge ) ]
+        ys = np.min( grid_y ) + ( np.max( grid_y ) - np.min( grid_y ) )*np.r_[
+                np.zeros_like( edge ), edge, np.ones_like( edge ), edge[::-1] ]
+        pts = self.crs.transform_points( isws_projection(), xs, ys )
+        domain = box( pts[:,0].min(), pts[:,1].min(),
+                      pts[:,0].max(), pts[:,1].max() )
+        tiles = list( self.find_images( domain, zoom ) )
+        for tile in tiles:
+            self.get_image( tile )
+        return len( tiles )
+#===============================
+
+
+
+# version of the background cache file layout (part of the key)
+_BACKGROUND_CACHE_VERSION = 1
+
+# hash of everything the pre-composited background depends on: the basemap
+# image, the label tile source, the zoom, the plotting extent and the width
+def background_key( img_bmp, tile_labels, grid_x, grid_y, zoom=15,
+                    width_px=2000 ):
+    img_bmp = np.ascontiguousarray( img_bmp )
+    labels  = None if tile_labels is None else tile_source_key( tile_labels )
+    hasher = hashlib.sha1( '{}|{}|{}|{}|{}|{}'.format(
+                               _BACKGROUND_CACHE_VERSION, labels, zoom,
+                               width_px, img_bmp.shape, img_bmp.dtype
+                               ).encode() )
+    hasher.update( img_bmp.tobytes() )
+    hasher.update( np.asarray([ np.min( grid_x ), np.max( grid_x ),
+                                np.min( grid_y ), np.max( grid_y ) ],
+                              dtype=float ).tobytes() )
+    return hasher.hexdigest()
+#===============================
+
+
+
+# composite the basemap (img_bmp) and the label tiles once into a single RGB
+# raster over the plotting extent (ISWS projection), width_px wide; frames then
+# pass it as img_bmp with tile_labels=None -> optionally stored in cache_file
+# with its background_key, and rebuilt when any of the inputs changed
+def composite_background( img_bmp, tile_labels, grid_x, grid_y, zoom=15,
+                          width_px=2000, cache_file=None ):
+    if cache_file is not None:
+        key = background_key( img_bmp, tile_labels, grid_x, grid_y, zoom,
+                              width_px )
+        # files without a key (plain arrays) or unreadable files are rebuilt
+        if os.path.isfile( cache_file ):
+            try:
+                cached = np.load( cache_file )
+                if hasattr( cached, 'files' ):
+                    with cached:
+                        if str( cached['key'] ) == key:
+                            return cached['background']
+            except Exception:
+                pass
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    # determine extent of plotting
+    meters_extent = np.asarray([ grid_x.min(), grid_x.max(),
+                                 grid_y.min(), grid_y.max() ])
+    isws_crs = isws_projection()
+    aspect = ( meters_extent[3] - meters_extent[2] )/( meters_extent[1] -
+                                                       meters_extent[0] )
+
+    # off-screen axes covering the whole figure
+    dpi = 100
+    fig = Figure( figsize=( width_px/dpi, width_px*aspect/dpi ), dpi=dpi )
+    canvas = FigureCanvasAgg( fig )
+    ax = fig.add_axes( [0, 0, 1, 1], projection=isws_crs )
+    ax.set_extent( meters_extent, crs=isws_crs )
+    ax.set_aspect( 'auto' )
+    ax.imshow( img_bmp, origin='upper',
+               extent=meters_extent, transform=isws_crs )
+    if tile_labels is not None:
+        ax.add_image( tile_labels, zoom, interpolation = 'spline36' )
+    ax.spines['geo'].set_visible( False )
+    ax.patch.set_visible( False )
+    canvas.draw()
+    background = np.array( canvas.buffer_rgba() )[...,:3]
+    fig.clear()
+
+    if cache_file is not None:
+        _save_npz_atomic( cache_file, key=np.asarray( key ),
+                          background=background )
+    return background
+
+
+
+#%% PERSISTENT FIGURE FOR RENDERING THE ANIMATION FRAMES
+
+# face colour of each risk code (as in plot_current_conditions)
+RISK_COLORS = { RISK_SURFACE: 'black', RISK_INFRASTRUCTURE: 'red',
+                RISK_BASEMENT: 'darkorange' }
+
+# legend of the risk colours (used by plot_current_conditions and the
+# FrameRenderer) -> returns the legend artist
+def _add_risk_legend( ax ):
+    labels = [ ( RISK_SURFACE, 'Surface Flooding' ),
+               ( RISK_INFRASTRUCTURE, 'Infrastructure Damage' ),
+               ( RISK_BASEMENT, 'Basement Flooding' ) ]
+    legend_elements = [ mpatches.Patch( facecolor=RISK_COLORS[code],
+                                        edgecolor='black', label=label )
+                        for code, label in labels ]
+    return ax.legend( handles=legend_elements, loc=1,
+                      title='Legend', title_fontsize=21,
+                      fontsize=18, shadow=True )
+#===============================
+
+
+
+# risk code of every polygon from the index arrays of plot_current_conditions
+# (surface flooding, then infrastructure damage, then basement flooding)
+def risk_codes_from_indices( n_polygons, flood_indices, infra_indices,
+                             bsmnt_indices ):
+    codes = np.full( n_polygons, RISK_NONE, dtype=int )
+    codes[ np.asarray( bsmnt_indices, dtype=int ) ] = RISK_BASEMENT
+    codes[ np.asarray( infra_indices, dtype=int ) ] = RISK_INFRASTRUCTURE
+    codes[ np.asarray( flood_indices, dtype=int ) ] = RISK_SURFACE
+    return codes
+#===============================
+
+
+
+# exterior vertices of every geometry in a column of a (Geo)DataFrame
+def polygon_vertices( polygon_df, column='geometry' ):
+    return [ np.asarray( geom.exterior.xy ).T
+             for geom in polygon_df.loc[:,column] ]
+#===============================
+
+
+
+# RGBA face colour of every polygon, looked up from its risk code
+# (row 0 of the table -> transparent for RISK_NONE)
+RISK_FACE_RGBA = np.asarray( [ (0.0, 0.0, 0.0, 0.0) ] +
+                             [ mcolors.to_rgba( RISK_COLORS[code], alpha=0.55 )
+                               for code in ( RISK_SURFACE, RISK_BASEMENT,
+                                             RISK_INFRASTRUCTURE ) ] )
+
+def risk_face_colors( codes ):
+    return RISK_FACE_RGBA[ np.asarray( codes, dtype=int ) - RISK_NONE ]
+#===============================
+
+
+
+# the figure of plot_current_conditions built once (off-screen, Agg canvas):
+# basemap and tiles are drawn a single time and kept as the background; each
+# frame only restores it and redraws the polygon faces and boundaries (one
+# collection each), the wells, the legend and the title -> render() returns
+# the frame as an RGBA array
+class FrameRenderer:
+
+    # initialization function for class
+    def __init__( self, soln_dict, grid_x, grid_y, polygon_df, point_df,
+                  tile_labels, img_bmp, desired_fig_w=20, zoom=15, dpi=100 ):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        # determine extent of plotting
+        meters_extent = np.asarray([ grid_x.min(), grid_x.max(),
+                                     grid_y.min(), grid_y.max() ])
+        isws_crs = isws_projection()
+
+        # determining raster scale
+        height = soln_dict['bounds'][3] - soln_dict['bounds'][1]
+        width  = soln_dict['bounds'][2] - soln_dict['bounds'][0]
+
+        # off-screen figure (no GUI, never shown)
+        self.fig = Figure( figsize=( desired_fig_w,
+                                     desired_fig_w*(height/width)), dpi=dpi )
+        self.canvas = FigureCanvasAgg( self.fig )
+        self.fig.set_tight_layout(True)
+        self.ax = self.fig.add_subplot( 1,1,1, projection=isws_crs )
+        self.ax.set_title( " ", fontsize=48 )
+        self.ax.title.set_animated( True )
+        self.ax.set_extent( meters_extent, crs=isws_crs )
+        # adding the "google" basemap
+        self.ax.imshow( img_bmp, origin='upper',
+                        extent=meters_extent, transform=isws_crs )
+        if tile_labels is not None:
+            self.ax.add_image( tile_labels, zoom, interpolation = 'spline36' )
+
+        # polygon faces (transparent until at risk) and boundaries
+        poly_verts = polygon_vertices( polygon_df )
+        self.faces = self.ax.add_collection( mcollections.PolyCollection(
+                            poly_verts, facecolors=risk_face_colors(
+                                    np.full( len(poly_verts), RISK_NONE ) ),
+                            edgecolors='none', transform=isws_crs,
+                            animated=True ), autolim=False )
+        self.outlines = self.ax.add_collection( mcollections.PolyCollection(
+                            poly_verts, facecolors='none', edgecolors='black',
+                            linewidths=2, transform=isws_crs, animated=True ),
+                            autolim=False )
+
+        # wells (buffer regions), drawn above the polygons
+        self.wells = self.ax.add_collection( mcollections.PolyCollection(
+                            polygon_vertices( point_df, 'buff_geometry' ),
+                            facecolors='none', edgecolors='red', linewidths=2,
+                            transform=isws_crs, animated=True ), autolim=False )
+
+        # add legend, drawn last (above the polygons)
+        self.legend = _add_risk_legend( self.ax )
+        self.legend.set_animated( True )
+
+        self.__background = None
+        self.__title_background = None
+        self.__codes = None
+
+    # update the polygon face colours (risk code lookup) and the title
+    def update( self, codes, cur_time ):
+        self.faces.set_facecolor( risk_face_colors( codes ) )
+        self.ax.title.set_text( "Time: {:.2f} Hour(s) ".format(cur_time) )
+
+    # draw the frame for the risk codes and time -> (height, width, 4) uint8
+    # -> same risk codes as the previous frame: only the title strip is redrawn
+    def render( self, codes, cur_time ):
+        codes = np.asarray( codes, dtype=int )
+        if self.__codes is not None and np.array_equal( codes, self.__codes ):
+            self.ax.title.set_text( "Time: {:.2f} Hour(s) ".format(cur_time) )
+            self.canvas.restore_region( self.__title_background )
+            self.ax.draw_artist( self.ax.title )
+            return np.array( self.canvas.buffer_rgba() )
+
+        self.update( codes, cur_time )
+        # static layers are drawn once (animated artists are skipped)
+        if self.__background is None:
+            self.canvas.draw()
+            self.__background = self.canvas.copy_from_bbox( self.fig.bbox )
+            # strip above the map (title only)
+            self.__title_background = self.canvas.copy_from_bbox(
+                    mtransforms.Bbox.from_extents( self.fig.bbox.x0,
+                                                   self.ax.bbox.y1,
+                                                   self.fig.bbox.x1,
+                                                   self.fig.bbox.y1 ) )
+        else:
+            self.canvas.restore_region( self.__background )
+        for artist in ( self.faces, self.outlines, self.wells, self.legend,
+                        self.ax.title ):
+            self.ax.draw_artist( artist )
+        self.__codes = codes.copy()
+        return np.array( self.canvas.buffer_rgba() )
+
+    # the map with no polygon at risk and that map blended with each risk
+    # colour -> the palette_frames of an AnimationWriter, so its GIF palette
+    # holds every colour the polygons can take
+    def risk_samples( self, cur_time=0.0 ):
+        frame = self.render( np.full( len( self.faces.get_paths() ), RISK_NONE ),
+                             cur_time )[...,:3]
+        return [ frame ] + risk_color_blends( frame )
+
+    # render the frame and write it to figsave_file
+    def save( self, codes, cur_time, figsave_file ):
+        frame = self.render( codes, cur_time )
+        imageio.imwrite( figsave_file, frame )
+        return frame
+
+    # release the figure
+    def close( self ):
+        self.__background = None
+        self.__title_background = None
+        self.__codes = None
+        self.fig.clear()
+
+
+
+#%% ANIMATION WITH DUPLICATE FRAME ELISION
+
+# render the frames (rows of risk_codes, one per time in times) with a
+# FrameRenderer and stream them to filename (see AnimationWriter); runs of
+# consecutive frames with the same risk codes are either
+#   'merge' -> a single frame (time of the first) shown for the whole run
+#   'title' -> kept, with only the title strip redrawn (and, for GIF, stored)
+# -> GIF palette from the renderer's risk_samples unless palette_frames given
+# -> returns the number of frames written
+def write_risk_animation( filename, risk_codes, times, renderer,
+                          frames_per_sec=1, duplicates='merge',
+                          palette_frames=None ):
+    if duplicates not in ('merge', 'title'):
+        raise Exception( ('Duplicate frame mode "{}" is not "merge" or '+
+                          '"title".').format( duplicates ) )
+    risk_codes = np.asarray( risk_codes, dtype=int )
+    times = np.asarray( times, dtype=float ).reshape(-1)
+    if risk_codes.shape[0] != times.size:
+        raise Exception( ('{} frames of risk codes were provided for {} '+
+                          'times.').format( risk_codes.shape[0], times.size ) )
+
+    # first frame of each run of identical risk codes
+    if times.size > 0:
+        new_run = np.r_[ True, np.any( risk_codes[1:] != risk_codes[:-1],
+                                       axis=1 ) ]
+    else:
+        new_run = np.zeros( 0, dtype=bool )
+    if duplicates == 'merge':
+        starts  = np.flatnonzero( new_run )
+        lengths = np.diff( np.r_[ starts, times.size ] )
+    else:
+        starts  = np.arange( times.size )
+        lengths = np.ones( times.size, dtype=int )
+
+    # palette holding every risk colour (the first frame may have none)
+    if palette_frames is None and filename.lower().endswith( '.gif' ):
+        palette_frames = renderer.risk_samples( times[0] if times.size else 0.0 )
+
+    with AnimationWriter( filename, frames_per_sec=frames_per_sec,
+                          palette_frames=palette_frames ) as writer:
+        for start, length in zip( starts, lengths ):
+            writer.append( renderer.render( risk_codes[start], times[start] ),
+                           duration=length*writer.frame_ms )
+    return starts.size
+
+
+
+#%% HEADLESS FRAME RENDERING ACROSS A PROCESS POOL
+
+# renderer built once within each worker process
+_WORKER_RENDERER = {}
+
+# deterministic, zero-padded frame file names -> frame_0000.png, frame_0001.png
+def frame_file_names( frame_dir, n_frames, prefix='frame_', ext='png' ):
+    width = max( 4, len( str( max( n_frames - 1, 0 ) ) ) )
+    return [ os.path.join( frame_dir, '{}{:0{}d}.{}'.format( prefix, idx,
+                                                             width, ext ) )
+             for idx in range( n_frames ) ]
+#===============================
+
+
+
+# worker initializer -> no GUI (Agg) and the static map layers built once
+def _init_renderer( renderer_kwargs ):
+    plt.switch_backend( 'Agg' )
+    _WORKER_RENDERER['renderer'] = FrameRenderer( **renderer_kwargs )
+#===============================
+
+
+
+# worker -> render a block of frames from their risk codes and times
+def _render_block_worker( codes_block, times_block, files_block ):
+    renderer = _WORKER_RENDERER['renderer']
+    for codes, cur_time, frame_file in zip( codes_block, times_block,
+                                            files_block ):
+        renderer.save( codes, cur_time, frame_file )
+    return files_block
+#===============================
+
+
+
+# render every frame (rows of risk_codes, one per time in times) to frame_dir
+# in contiguous blocks across worker processes (n_workers=1 -> in process)
+# -> FrameRenderer arguments are passed through renderer_kwargs
+# -> returns the frame files in frame order
+def render_frames_parallel( frame_dir, risk_codes, times, renderer_kwargs,
+                            n_workers=None, block_size=None, prefix='frame_',
+                            ext='png' ):
+    risk_codes = np.asarray( risk_codes, dtype=int )
+    times = np.asarray( times, dtype=float ).reshape(-1)
+    if risk_codes.shape[0] != times.size:
+        raise Exception( ('{} frames of risk codes were provided for {} '+
+                          'times.').format( risk_codes.shape[0], times.size ) )
+    os.makedirs( frame_dir, exist_ok=True )
+    frame_files = frame_file_names( frame_dir, times.size, prefix, ext )
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    # one contiguous block per worker by default (static layers built once each)
+    if block_size is None:
+        block_size = max( 1, int( math.ceil( times.size/n_workers ) ) )
+    blocks = [ slice( b0, b0 + block_size )
+               for b0 in range( 0, times.size, block_size ) ]
+
+    # single worker -> render in this process
+    if n_workers == 1:
+        renderer = FrameRenderer( **renderer_kwargs )
+        for block in blocks:
+            for codes, cur_time, frame_file in zip( risk_codes[block],
+                                                    times[block],
+                                                    frame_files[block] ):
+                renderer.save( codes, cur_time, frame_file )
+        renderer.close()
+        return frame_files
+
+    with ProcessPoolExecutor( max_workers=n_workers, initializer=_init_renderer,
+                              initargs=(renderer_kwargs,) ) as pool:
+        futures = [ pool.submit( _render_block_worker, risk_codes[block],
+                                 times[block], frame_files[block] )
+                    for block in blocks ]
+        for future in futures:
+            future.result()
+
+    return frame_files
+
+
+
+#%% THE WELL FUNCTION W(u)
+
+# Abramowitz & Stegun (1964) 5.1.53: W(u) + ln(u) polynomial for 0 <= u <= 1
+_W_POLY = ( -0.57721566, 0.99999193, -0.24991055, 0.05519968,
+            -0.00976004, 0.00107857 )
+# Abramowitz & Stegun (1964) 5.1.56: u*exp(u)*W(u) rational for 1 <= u < inf
+_W_RAT_NUM = ( 8.5733287401, 18.0590169730, 8.6347608925, 0.2677737343 )
+_W_RAT_DEN = ( 9.5733223454, 25.6329561486, 21.0996530827, 3.9584969228 )
+
+# available accuracy modes of the well function
+#   'exact' -> scipy.special.exp1
+#   'fast'  -> piecewise A&S approximations, max. relative error < 1e-6
+#              (absolute error < 2e-7 for u <= 1, relative < 3.4e-8 for u > 1)
+WELL_FUNCTION_MODES = ('exact', 'fast')
+
+# Theis well function, W(u) = E1(u) = exponential integral
+def well_function( u, mode='exact' ):
+    if mode == 'exact':
+        return sps.exp1( u )
+    elif mode != 'fast':
+        raise Exception( ('Well function mode "{}" is not one of: {}.').format(
+                         mode, WELL_FUNCTION_MODES ) )
+
+    # keep the precision of u (float32 or float64)
+    u   = np.asarray( u )
+    if not np.issubdtype( u.dtype, np.floating ):
+        u = u.astype( float )
+    out = np.empty( u.shape, dtype=u.dtype )
+    # small arguments: polynomial less the logarithm (u=0 -> inf, as exp1)
+    small = u < 1.0
+    us    = u[small]
+    with np.errstate( divide='ignore' ):
+        out[small] = ( _W_POLY[0] + us*( _W_POLY[1] + us*( _W_POLY[2] +
+                       us*( _W_POLY[3] + us*( _W_POLY[4] + us*_W_POLY[5] ) ) ) ) -
+                       np.log( us ) )
+    # large arguments: rational function in 1/u (u=inf -> 0, as exp1)
+    large = ~small
+    inv   = 1.0/u[large]
+    num   = 1 + inv*( _W_RAT_NUM[0] + inv*( _W_RAT_NUM[1] +
+                inv*( _W_RAT_NUM[2] + inv*_W_RAT_NUM[3] ) ) )
+    den   = 1 + inv*( _W_RAT_DEN[0] + inv*( _W_RAT_DEN[1] +
+                inv*( _W_RAT_DEN[2] + inv*_W_RAT_DEN[3] ) ) )
+    out[large] = np.exp( -u[large] )*inv*num/den
+    return out
+#===============================
+
+
+
+# inverse of the well function -> u such that W(u) = W_target
+# (vectorized bisection on log(u); W is strictly decreasing in u)
+def inverse_well_function( W_target, n_iter=64 ):
+    W_target = np.asarray( W_target, dtype=float )
+    # bracket u between 1e-20 (W ~ 45.5) and 1e3 (W underflows to 0)
+    lo = np.full( W_target.shape, math.log(1e-20) )
+    hi = np.full( W_target.shape, math.log(1e3) )
+    for _ in range( n_iter ):
+        mid = 0.5*( lo + hi )
+        above = sps.exp1( np.exp( mid ) ) > W_target
+        # W(mid) above the target -> root lies at larger u
+        lo = np.where( above, mid, lo )
+        hi = np.where( above, hi, mid )
+    # the upper bracket guarantees W(u) <= W_target
+    return np.exp( hi )
+#===============================
+
+
+
+# time and compare the well function modes on a realistic range of u
+# -> r = 1 to 3,000 m, t = 0.1 to 1,000 hrs, T and S of the American Bottom
+def benchmark_well_function( n_samples=2000000, T=100.0, S=0.1, repeats=5,
+                             seed=0 ):
+    # sample radii and times log-uniformly and build u = r^2 S / (4 T t)
+    rng = np.random.default_rng( seed )
+    rrr = 10**rng.uniform( 0, np.log10(3000), n_samples )
+    ttt = 10**rng.uniform( -1, 3, n_samples )
+    u   = rrr**2*S/(4*T*ttt)
+
+    # time each mode (best of the repeats)
+    timing = {}
+    for mode in WELL_FUNCTION_MODES:
+        best = np.inf
+        for _ in range( repeats ):
+            start = time.perf_counter()
+            well_function( u, mode=mode )
+            best = min( best, time.perf_counter() - start )
+        timing[mode] = best
+
+    # relative error where W(u) is a normal float (exp1 underflows at u > ~700)
+    exact  = well_function( u, mode='exact' )
+    fast   = well_function( u, mode='fast' )
+    valid  = exact > np.finfo( float ).tiny
+    relerr = np.abs( fast[valid] - exact[valid] )/exact[valid]
+
+    # update user
+    print( ('Well function benchmark: {:,} samples, u = {:.2e} to {:.2e}\n'+
+            '  exact: {:.4f} s\n'+
+            '  fast:  {:.4f} s ({:.1f}x speedup)\n'+
+            '  max. relative error = {:.2e}\n').format(
+                    n_samples, u.min(), u.max(), timing['exact'], timing['fast'],
+                    timing['exact']/timing['fast'], relerr.max() ) )
+
+    return { 'u_range': (u.min(), u.max()), 'exact_sec': timing['exact'],
+             'fast_sec': timing['fast'], 'max_rel_error': relerr.max() }
+
+
+
 #%% FUNCTION TO CALCULATE THE THEIS SOLUTION FOR EACH WELL
         
-def TheisFunc( x, y, Q, T, S, t_time, x_well, y_well):
+def TheisFunc( x, y, Q, T, S, t_time, x_well, y_well, well_fn='exact'):
     # determining radius of every grid point relative to the well
     rrr= (((x_well-x)**2)+((y_well-y)**2))**0.5
-    return Q/(4*math.pi*T)*sps.exp1((rrr**2)*S/(4*T*abs(t_time)))*m2ft
+    return Q/(4*math.pi*T)*well_function((rrr**2)*S/(4*T*abs(t_time)),
+                                         mode=well_fn)*m2ft
+
+
+#%% CACHE OF THE WELL-TO-GRID DISTANCES
+
+# squared radius (r^2) of each grid cell relative to each well -> (wells, cells)
+# -> differences taken in the coordinates' precision, then cast to dtype
+def well_distance_squared( xflat, yflat, x_wells, y_wells, dtype=None ):
+    r2 = ( ( np.asarray(x_wells)[:,np.newaxis] - xflat[np.newaxis,:] )**2 +
+           ( np.asarray(y_wells)[:,np.newaxis] - yflat[np.newaxis,:] )**2 )
+    if dtype is None:
+        return r2
+    return r2.astype( dtype, copy=False )
+#===============================
+
+
+
+# remove a file, ignoring a file that is already gone (or still in use)
+def _remove_quietly( filename ):
+    try:
+        os.remove( filename )
+    except OSError:
+        pass
+#===============================
+
+
+
+# wells and grid do not move between timesteps -> store r^2 once and reuse it
+class DistanceCache:
+
+    # initialization function for class
+    def __init__( self, max_bytes=512*2**20, max_entries=8, spill_dir=None,
+                  cell_chunk=65536 ):
+        # RAM budget (bytes) and number of distance sets retained
+        self.max_bytes   = max_bytes
+        self.max_entries = max_entries
+        # folder for memory-mapped files of sets too large for the RAM budget
+        self.spill_dir   = spill_dir
+        self.cell_chunk  = cell_chunk
+        # least recently used entries are first -> evicted first
+        self.__entries   = OrderedDict()
+        self.__spilled   = {}
+        self.hits        = 0
+        self.misses      = 0
+
+    # key the distance set on the grid and well coordinates (and precision)
+    @staticmethod
+    def make_key( x, y, x_wells, y_wells, dtype=np.float64 ):
+        hasher = hashlib.sha1( np.dtype( dtype ).str.encode() )
+        for arr in (x, y, x_wells, y_wells):
+            arr = np.ascontiguousarray( arr, dtype=float )
+            hasher.update( str( arr.shape ).encode() )
+            hasher.update( memoryview( arr ).cast('B') )
+        return hasher.hexdigest()
+
+    # return the (wells, cells) array of r^2, computing it on the first request
+    def get( self, x, y, x_wells, y_wells, dtype=np.float64 ):
+        dtype = np.dtype( dtype )
+        key = self.make_key( x, y, x_wells, y_wells, dtype )
+        if key in self.__entries:
+            self.hits += 1
+            self.__entries.move_to_end( key )
+            return self.__entries[key]
+        self.misses += 1
+
+        # flatten the grid and wells
+        xflat = np.asarray( x, dtype=float ).reshape(-1)
+        yflat = np.asarray( y, dtype=float ).reshape(-1)
+        xw    = np.asarray( x_wells, dtype=float ).reshape(-1)
+        yw    = np.asarray( y_wells, dtype=float ).reshape(-1)
+        shape = ( xw.size, xflat.size )
+
+        # keep in RAM if it fits the budget, else spill to a memory-mapped file
+        if dtype.itemsize*shape[0]*shape[1] <= self.max_bytes:
+            r2 = np.empty( shape, dtype=dtype )
+        else:
+            spill_dir = self.spill_dir if self.spill_dir else tempfile.gettempdir()
+            spill_file = os.path.join( spill_dir, 'theis_r2_{}.dat'.format(key) )
+            r2 = np.memmap( spill_file, dtype=dtype, mode='w+', shape=shape )
+            self.__spilled[key] = spill_file
+
+        # fill in blocks of cells to bound the temporary memory
+        for c0 in range( 0, shape[1], self.cell_chunk ):
+            c1 = min( c0 + self.cell_chunk, shape[1] )
+            r2[:, c0:c1] = well_distance_squared( xflat[c0:c1], yflat[c0:c1],
+                                                  xw, yw )
+        if isinstance( r2, np.memmap ):
+            r2.flush()
+
+        # store and apply the eviction policy
+        self.__entries[key] = r2
+        self.__evict()
+        return r2
+
+    # bytes of the distance sets held in RAM (spilled sets excluded)
+    def ram_bytes( self ):
+        return sum( r2.nbytes for key, r2 in self.__entries.items()
+                    if key not in self.__spilled )
+
+    # evict least recently used sets beyond the entry count or RAM budget
+    def __evict( self ):
+        while len( self.__entries ) > 1 and \
+              ( len( self.__entries ) > self.max_entries or
+                self.ram_bytes() > self.max_bytes ):
+            key, r2 = self.__entries.popitem( last=False )
+            self.__release( key, r2 )
+
+    # drop a set, removing its memory-mapped file if spilled; arrays already
+    # returned by get() stay mapped (and readable) -> the file is unlinked now
+    # (POSIX) or once the last reference to the array is gone (Windows)
+    def __release( self, key, r2 ):
+        if key in self.__spilled:
+            spill_file = self.__spilled.pop( key )
+            try:
+                os.remove( spill_file )
+            except OSError:
+                weakref.finalize( r2, _remove_quietly, spill_file )
+
+    # empty the cache
+    def clear( self ):
+        while self.__entries:
+            key, r2 = self.__entries.popitem( last=False )
+            self.__release( key, r2 )
+
+    def __len__( self ):
+        return len( self.__entries )
+#===============================
+
+
+
+# check that distance sets spilled to disk stay readable after the cache
+# evicts them and after it is cleared (the caller may still hold them)
+def check_distance_cache_release( n_cells=20000, n_wells=4 ):
+    rng = np.random.default_rng( 0 )
+    x, y = rng.uniform( 0, 1000, (2, n_cells) )
+    xw, yw = rng.uniform( 0, 1000, (2, n_wells) )
+    expected = well_distance_squared( x, y, xw, yw ).sum()
+
+    # RAM budget too small -> every set is spilled to a memory-mapped file
+    dist_cache = DistanceCache( max_bytes=1, max_entries=1 )
+    r2_first = dist_cache.get( x, y, xw, yw )
+    # a second set evicts the first, then the cache is emptied
+    r2_second = dist_cache.get( x, y, xw + 1.0, yw )
+    evicted_ok = np.isclose( r2_first.sum(), expected )
+    dist_cache.clear()
+    cleared_ok = np.isclose( r2_first.sum(), expected ) and \
+                 np.isfinite( r2_second.sum() )
+    if not ( evicted_ok and cleared_ok ):
+        raise Exception('Distance sets returned by the cache were not readable '+
+                        'after eviction or clear().')
+
+    # update user
+    print( 'Distance cache check: returned sets readable after eviction '+
+           'and clear().\n' )
+    return True
+
+
+
+#%% BATCHED THEIS SUPERPOSITION FOR ALL WELLS AT ONCE
+
+# determine the Theis time terms (time, sign) for the current timestep
+def theis_time_terms( t_time, t_stagger=None ):
+    # pumping -> a single term
+    if t_time > 0:
+        return [ (t_time, 1.0) ]
+    # recovery -> continue pumping and superimpose an injection of the same rate
+    if t_stagger is None:
+        raise Exception('A staggering time (t[1]) is required for recovery '+
+                        'timesteps (t_time <= 0).')
+    # staggering the solution time for pumping and injecting by t[1]
+    return [ (t_stagger + abs(t_time), 1.0), (abs(t_time), -1.0) ]
+#===============================
+
+
+
+# elapsed time and rate of every Theis term of every well -> (wells, terms)
+# -> inactive terms carry a zero rate (and an infinite elapsed time)
+def theis_well_terms( Qw, t_time, t_stagger=None, schedule=None ):
+    # constant rate pumping (t > 0) or recovery (t <= 0)
+    if schedule is None:
+        terms   = theis_time_terms( t_time, t_stagger )
+        elapsed = np.tile( [ abs(tt) for tt, sign in terms ], ( Qw.size, 1 ) )
+        rates   = Qw[:,np.newaxis]*np.asarray( [ sign for tt, sign in terms ] )
+    # piecewise-constant rates -> one term per rate change already started
+    else:
+        elapsed = t_time - schedule['t_on']
+        active  = ( elapsed > 0 ) & ( schedule['dQ'] != 0 )
+        elapsed = np.where( active, elapsed, np.inf )
+        rates   = np.where( active, schedule['dQ'], 0.0 )
+    return elapsed, rates
+#===============================
+
+
+
+# superimpose the terms of each well on a block of cells -> (wells, cells) in ft
+# -> vectorized across wells and rate changes, inactive terms skipped
+def _theis_terms_block( r2_blk, elapsed, rates, T, S, well_fn='exact' ):
+    dtype  = r2_blk.dtype
+    well_s = np.zeros( r2_blk.shape, dtype=dtype )
+    # active (well, term) pairs, ordered by well
+    wi, ki = np.nonzero( rates )
+    if wi.size == 0:
+        return well_s
+    # well function of every active term, weighted by its change in rate
+    u = r2_blk[wi]*( S/(4*T*elapsed[wi,ki]) ).astype( dtype )[:,np.newaxis]
+    term_s = well_function( u, mode=well_fn )
+    term_s *= rates[wi,ki].astype( dtype )[:,np.newaxis]
+    # sum the terms of each well
+    starts = np.flatnonzero( np.r_[ True, wi[1:] != wi[:-1] ] )
+    well_s[ wi[starts] ] = np.add.reduceat( term_s, starts, axis=0 )
+    well_s *= m2ft/(4*math.pi*T)
+    return well_s
+#===============================
+
+
+
+# radius beyond which the drawdown of each well falls below tol (ft)
+# -> recovery drawdown (W(u2) - W(u1)) is bounded by the longest time term
+def theis_cutoff_radius( Q, T, S, t_time, tol, t_stagger=None, schedule=None ):
+    Qw = np.atleast_1d( np.asarray( Q, dtype=float ) )
+    if schedule is not None:
+        Qw = np.zeros( schedule['dQ'].shape[0] )
+    elapsed, rates = theis_well_terms( Qw, t_time, t_stagger, schedule )
+    return _cutoff_radius_terms( elapsed, rates, T, S, tol )
+#===============================
+
+
+
+# cutoff radius from the terms of each well -> |s| <= sum|dQ| W(u(t_max))/(4 pi T)
+def _cutoff_radius_terms( elapsed, rates, T, S, tol ):
+    Q_bound = np.abs( rates ).sum( axis=1 )
+    t_max   = np.where( rates != 0, elapsed, 0.0 ).max( axis=1 )
+    # well function value at which Q/(4 pi T) W(u) = tol
+    with np.errstate( divide='ignore' ):
+        W_target = tol*4*math.pi*T/( Q_bound*m2ft )
+    u_cut = inverse_well_function( W_target )
+    return np.sqrt( u_cut*4*T*t_max/S )
+#===============================
+
+
+
+# grid axes of a rectilinear (meshgrid) grid -> xaxis (columns), yaxis (rows)
+# -> strict=False returns None (instead of raising) for other grids
+def grid_axes( x, y, strict=True ):
+    x = np.asarray( x )
+    y = np.asarray( y )
+    if x.ndim != 2 or x.shape != y.shape or \
+       not np.array_equal( x, np.broadcast_to( x[:1,:], x.shape ) ) or \
+       not np.array_equal( y, np.broadcast_to( y[:,:1], y.shape ) ):
+        if not strict:
+            return None
+        raise Exception('The grid is not a rectilinear (meshgrid) grid; '+
+                        'windowed evaluation is not possible.')
+    return x[0,:], y[:,0]
+#===============================
+
+
+
+# maximum drawdown of each well from the few cells nearest to it, instead of
+# from the well's full-grid solution -> exact whenever drawdown decreases with
+# r (constant rate pumping and recovery, W(u2) - W(u1) with u2 < u1, at a
+# non-negative rate; not for injection)
+def theis_nearest_max( x, y, xw, yw, elapsed, rates, T, S, well_fn='exact',
+                       dtype=np.float64, halo=1 ):
+    axes = grid_axes( x, y, strict=False )
+    # rectilinear grid -> (2*halo+1)^2 cells around the nearest row and column
+    if axes is not None:
+        xaxis, yaxis = axes
+        offset = np.arange( -halo, halo + 1 )
+        cols = np.argmin( np.abs( xaxis[np.newaxis,:] - xw[:,np.newaxis] ), axis=1 )
+        rows = np.argmin( np.abs( yaxis[np.newaxis,:] - yw[:,np.newaxis] ), axis=1 )
+        cols = np.clip( cols[:,np.newaxis] + offset, 0, xaxis.size - 1 )
+        rows = np.clip( rows[:,np.newaxis] + offset, 0, yaxis.size - 1 )
+        r2_nb = ( ( xaxis[cols] - xw[:,np.newaxis] )**2 )[:,np.newaxis,:] + \
+                ( ( yaxis[rows] - yw[:,np.newaxis] )**2 )[:,:,np.newaxis]
+        r2_nb = r2_nb.reshape( xw.size, -1 )
+    # any other set of cells -> the single nearest cell
+    else:
+        xflat = np.asarray( x ).reshape(-1)
+        yflat = np.asarray( y ).reshape(-1)
+        r2_nb = np.asarray( [ [ np.min( ( xflat - xes )**2 + ( yflat - yes )**2 ) ]
+                              for xes, yes in zip( xw, yw ) ] )
+    well_s = _theis_terms_block( r2_nb.astype( dtype ), elapsed, rates, T, S,
+                                 well_fn )
+    return well_s.max( axis=1 ).astype( float )
+#===============================
+
+
+
+# accumulate each well's solution only within its radius of influence
+def _theis_windowed( x, y, elapsed, rates, T, S, xw, yw, r_cut, RunSum,
+                     well_max, r2=None, well_fn='exact' ):
+    dtype = RunSum.dtype
+    xaxis, yaxis = grid_axes( x, y )
+    grid_shape = RunSum.shape
+    for wi in range( xw.size ):
+        # rows and columns of the window around the well (axes are monotonic)
+        cols = np.nonzero( np.abs( xaxis - xw[wi] ) <= r_cut[wi] )[0]
+        rows = np.nonzero( np.abs( yaxis - yw[wi] ) <= r_cut[wi] )[0]
+        if cols.size == 0 or rows.size == 0:
+            # no cells within the radius -> drawdown below tolerance everywhere
+            well_max[wi] = 0.0
+            continue
+        r0, r1 = rows[0], rows[-1] + 1
+        c0, c1 = cols[0], cols[-1] + 1
+
+        # squared radius within the window
+        if r2 is None:
+            r2_win = ( ( xaxis[np.newaxis,c0:c1] - xw[wi] )**2 +
+                       ( yaxis[r0:r1,np.newaxis] - yw[wi] )**2 ).astype( dtype )
+        else:
+            r2_win = np.asarray( r2[wi].reshape( grid_shape )[r0:r1,c0:c1],
+                                 dtype=dtype )
+        # superimpose the terms of the well
+        well_s = _theis_terms_block( r2_win.reshape( 1, -1 ),
+                                     elapsed[wi:wi+1], rates[wi:wi+1],
+                                     T, S, well_fn ).reshape( r2_win.shape )
+
+        # accumulate the window only
+        RunSum[r0:r1,c0:c1] += well_s
+        well_max[wi] = well_s.max()
+#===============================
+
+
+
+# superimpose the Theis solution of every well on the grid in one broadcasted
+# computation, evaluated in blocks of (wells x cells) to bound memory use
+# -> schedule (see pumping_schedule) replaces Q and t_stagger with variable rates
+# -> dtype sets the precision of the drawdown; out is an optional preallocated
+#    (C-contiguous, grid-shaped) buffer accumulated in place
+# -> track_max: 'nearest' (cells nearest each well), 'grid' (every cell), None;
+#    'auto' is 'nearest' for constant, non-negative rates and 'grid' for
+#    injection (any rate < 0) and pumping schedules
+def TheisSuperposition( x, y, Q, T, S, t_time, x_wells, y_wells, t_stagger=None,
+                        well_chunk=16, cell_chunk=65536, r2=None,
+                        well_fn='exact', cutoff_tol=None, schedule=None,
+                        dtype=np.float64, out=None, track_max='auto' ):
+    # flatten the grid (views, no copies for contiguous grids)
+    x = np.asarray( x )
+    grid_shape = x.shape
+    xflat = x.reshape(-1)
+    yflat = np.asarray( y ).reshape(-1)
+    # contiguous well coordinates and (per-well) discharge rates
+    xw = np.ascontiguousarray( x_wells, dtype=float ).reshape(-1)
+    yw = np.ascontiguousarray( y_wells, dtype=float ).reshape(-1)
+    Qw = np.broadcast_to( np.asarray( Q if schedule is None else 0.0,
+                                      dtype=float ), xw.shape )
+    n_wells, n_cells = xw.size, xflat.size
+
+    # running sum of the superimposed solution and per-well maximum drawdown
+    if out is None:
+        RunSum = np.zeros( n_cells, dtype=dtype )
+    else:
+        if out.shape != grid_shape or not out.flags['C_CONTIGUOUS']:
+            raise Exception('The output buffer must be a C-contiguous array '+
+                            'with the shape of the grid.')
+        RunSum = out.reshape(-1)
+        RunSum[...] = 0
+    well_max = np.full( n_wells, -np.inf )
+    if n_wells == 0:
+        return RunSum.reshape( grid_shape ), well_max
+
+    # elapsed time and rate of each Theis term of each well
+    if schedule is not None and schedule['dQ'].shape[0] != n_wells:
+        raise Exception( ('The pumping schedule has {} wells, not {}.').format(
+                         schedule['dQ'].shape[0], n_wells ) )
+    elapsed, rates = theis_well_terms( Qw, t_time, t_stagger, schedule )
+
+    # cutoff mode -> evaluate each well only within its radius of influence
+    if cutoff_tol is not None:
+        r_cut  = _cutoff_radius_terms( elapsed, rates, T, S, cutoff_tol )
+        RunSum = RunSum.reshape( grid_shape )
+        _theis_windowed( x, y, elapsed, rates, T, S, xw, yw, r_cut, RunSum,
+                         well_max, r2=r2, well_fn=well_fn )
+        return RunSum, well_max
+
+    # maximum drawdown of each well
+    if track_max == 'auto':
+        track_max = 'nearest' if schedule is None and not np.any( Qw < 0 ) \
+                    else 'grid'
+    if track_max == 'nearest':
+        well_max = theis_nearest_max( x, y, xw, yw, elapsed, rates, T, S,
+                                      well_fn=well_fn, dtype=RunSum.dtype )
+    elif track_max is None:
+        well_max[:] = np.nan
+
+    # loop through blocks of cells and wells
+    for c0 in range( 0, n_cells, cell_chunk ):
+        c1 = min( c0 + cell_chunk, n_cells )
+        for w0 in range( 0, n_wells, well_chunk ):
+            w1 = min( w0 + well_chunk, n_wells )
+            # squared radius of every cell in the block relative to each well
+            if r2 is None:
+                r2_blk = well_distance_squared( xflat[c0:c1], yflat[c0:c1],
+                                                xw[w0:w1], yw[w0:w1],
+                                                dtype=RunSum.dtype )
+            # reuse the (cached) squared radii when provided
+            else:
+                r2_blk = np.asarray( r2[w0:w1, c0:c1], dtype=RunSum.dtype )
+            # superimpose the time terms for each well
+            well_s = _theis_terms_block( r2_blk, elapsed[w0:w1], rates[w0:w1],
+                                         T, S, well_fn )
+            # accumulate the block (and track the maximum drawdown of each well)
+            RunSum[c0:c1] += well_s.sum( axis=0 )
+            if track_max == 'grid':
+                well_max[w0:w1] = np.maximum( well_max[w0:w1],
+                                              well_s.max( axis=1 ) )
+
+    return RunSum.reshape( grid_shape ), well_max
+
+
+#%% VARIABLE-RATE PUMPING SCHEDULES
+
+# piecewise-constant rate history of each well -> schedule dictionary
+#   change_times: list (per well) of the times (hrs) at which the rate changes
+#   rates:        list (per well) of the rates (cmh) starting at those times
+# -> temporal superposition: each change in rate (dQ) starts a new Theis term
+def pumping_schedule( change_times, rates ):
+    if len( change_times ) != len( rates ):
+        raise Exception('A rate history is required for every well.')
+    n_steps = max( [ len(times) for times in change_times ] + [1] )
+    # pad with terms that never start (t_on = inf, dQ = 0)
+    t_on = np.full( ( len(rates), n_steps ), np.inf )
+    dQ   = np.zeros( ( len(rates), n_steps ) )
+    for wi, (times, qqq) in enumerate( zip( change_times, rates ) ):
+        times = np.asarray( times, dtype=float )
+        qqq   = np.asarray( qqq, dtype=float )
+        if times.size != qqq.size:
+            raise Exception( ('Well #{} has {} rate change times but {} '+
+                              'rates.').format( wi, times.size, qqq.size ) )
+        if np.any( np.diff( times ) <= 0 ):
+            raise Exception( ('The rate change times of well #{} are not '+
+                              'increasing.').format( wi ) )
+        t_on[wi, :times.size] = times
+        dQ[wi, :qqq.size]     = np.diff( qqq, prepend=0.0 )
+    return { 't_on': t_on, 'dQ': dQ }
+#===============================
+
+
+
+# constant rate pumping for t_pump hrs followed by recovery (as TheisModule)
+# -> evaluate at t_pump + |ttt| for the recovery timesteps (ttt <= 0)
+def constant_rate_schedule( Q, t_pump, n_wells=None ):
+    Qw = np.atleast_1d( np.asarray( Q, dtype=float ) )
+    if n_wells is not None:
+        Qw = np.broadcast_to( Qw, ( n_wells, ) )
+    return pumping_schedule( [ [0.0, t_pump] ]*Qw.size,
+                             [ [qqq, 0.0] for qqq in Qw ] )
+
+
+
+#%% ALL TIMESTEPS AT ONCE -> WATER TABLE CUBE
+
+# evaluate every timestep in t and return the (n_times, ny, nx) water table cube
+# and the (n_wells, n_times) maximum drawdown due to each singular well
+def TheisCube( aquifer, xxx, yyy, t, x_wells, y_wells, Q=None, init_cond=0.0,
+               t_stagger=None, out_file=None, dist_cache=None,
+               well_chunk=16, cell_chunk=65536, well_fn='exact',
+               cutoff_tol=None, schedule=None, dtype=np.float64,
+               track_max='auto' ):
+    # timesteps: pumping (t > 0) and recovery (t <= 0), or schedule times
+    t = np.asarray( t, dtype=float ).reshape(-1)
+    # staggering the solution time for pumping and injecting by t[1]
+    if t_stagger is None and schedule is None and np.any( t <= 0 ):
+        t_stagger = t[1]
+    # default to the aquifer discharge rate for every well
+    if Q is None:
+        Q = aquifer['discharge']
+    x_wells = np.asarray( x_wells, dtype=float ).reshape(-1)
+    y_wells = np.asarray( y_wells, dtype=float ).reshape(-1)
+
+    # allocate the cube in memory or straight in a memory-mapped .npy file
+    cube_shape = ( t.size, ) + np.shape( xxx )
+    if out_file is None:
+        cube = np.empty( cube_shape, dtype=dtype )
+    else:
+        cube = np.lib.format.open_memmap( out_file, mode='w+', dtype=dtype,
+                                          shape=cube_shape )
+    MAX_DD = np.full( ( x_wells.size, t.size ), np.nan )
+
+    # wells and grid are fixed -> distances computed once for all timesteps
+    local_cache = dist_cache is None
+    if local_cache:
+        dist_cache = DistanceCache()
+    r2 = dist_cache.get( xxx, yyy, x_wells, y_wells, dtype=dtype )
+
+    # loop through the timesteps
+    for tti, ttt in enumerate( t ):
+        RunSum, well_max = TheisSuperposition( xxx, yyy, Q, aquifer['trans'],
+                                               aquifer['stor'], ttt,
+                                               x_wells, y_wells,
+                                               t_stagger=t_stagger,
+                                               well_chunk=well_chunk,
+                                               cell_chunk=cell_chunk, r2=r2,
+                                               well_fn=well_fn,
+                                               cutoff_tol=cutoff_tol,
+                                               schedule=schedule, dtype=dtype,
+                                               out=cube[tti],
+                                               track_max=track_max )
+        # difference between drawdown or residual drawdown and the initial condition
+        np.subtract( init_cond, RunSum, out=RunSum )
+        MAX_DD[:, tti] = well_max
+
+    # clean up
+    if local_cache:
+        dist_cache.clear()
+    if isinstance( cube, np.memmap ):
+        cube.flush()
+
+    return cube, MAX_DD
+
+
+
+#%% PARALLEL TIMESTEPS ACROSS A PROCESS POOL
+
+# shared arrays attached within each worker process -> name: (shm, array)
+_WORKER_SHARED = {}
+
+# copy an array into a new shared memory block -> (shm, array, spec)
+def _to_shared( arr ):
+    arr = np.ascontiguousarray( arr )
+    shm = shared_memory.SharedMemory( create=True, size=max( arr.nbytes, 1 ) )
+    shared = np.ndarray( arr.shape, dtype=arr.dtype, buffer=shm.buf )
+    shared[...] = arr
+    return shm, shared, ( shm.name, arr.shape, arr.dtype.str )
+#===============================
+
+
+
+# worker initializer -> attach to the shared grid, DEM, and output cube
+def _attach_shared( specs ):
+    for key, (shm_name, shape, dtype) in specs.items():
+        # the parent owns (and unlinks) the blocks -> workers do not track them
+        try:
+            shm = shared_memory.SharedMemory( name=shm_name, track=False )
+        except TypeError:
+            # Python < 3.13 -> pool workers share the parent's resource tracker
+            shm = shared_memory.SharedMemory( name=shm_name )
+        _WORKER_SHARED[key] = ( shm, np.ndarray( shape, dtype=dtype,
+                                                 buffer=shm.buf ) )
+#===============================
+
+
+
+# worker -> evaluate a block of timesteps into the shared (or memory-mapped) cube
+def _theis_block_worker( tti_block, t_block, out_file, kwargs ):
+    xxx  = _WORKER_SHARED['xxx'][1]
+    yyy  = _WORKER_SHARED['yyy'][1]
+    init = _WORKER_SHARED['init_cond'][1]
+    if out_file is None:
+        cube = _WORKER_SHARED['cube'][1]
+    else:
+        cube = np.load( out_file, mmap_mode='r+' )
+
+    # loop through the block of timesteps (accumulating in the cube in place)
+    well_maxes = []
+    for tti, ttt in zip( tti_block, t_block ):
+        RunSum, well_max = TheisSuperposition( xxx, yyy, t_time=ttt,
+                                               out=cube[tti], **kwargs )
+        np.subtract( init, RunSum, out=RunSum )
+        well_maxes.append( well_max )
+
+    if out_file is not None:
+        cube.flush()
+    return tti_block, np.asarray( well_maxes )
+#===============================
+
+
+
+# same output as TheisCube, with blocks of timesteps spread across processes;
+# the grid and DEM (init_cond) are shared through shared memory, not pickled
+def TheisParallel( aquifer, xxx, yyy, t, x_wells, y_wells, Q=None, init_cond=0.0,
+                   t_stagger=None, out_file=None, n_workers=None, block_size=None,
+                   well_chunk=16, cell_chunk=65536, well_fn='exact',
+                   cutoff_tol=None, schedule=None, dtype=np.float64,
+                   track_max='auto' ):
+    # timesteps: pumping (t > 0) and recovery (t <= 0), or schedule times
+    t = np.asarray( t, dtype=float ).reshape(-1)
+    if t_stagger is None and schedule is None and np.any( t <= 0 ):
+        t_stagger = t[1]
+    if Q is None:
+        Q = aquifer['discharge']
+    x_wells = np.asarray( x_wells, dtype=float ).reshape(-1)
+    y_wells = np.asarray( y_wells, dtype=float ).reshape(-1)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    # default to a few blocks per worker to balance the load
+    if block_size is None:
+        block_size = max( 1, int( math.ceil( t.size/(4*n_workers) ) ) )
+
+    # place the grid, DEM, and (in-memory) output cube in shared memory
+    cube_shape = ( t.size, ) + np.shape( xxx )
+    blocks, specs = [], {}
+    for key, arr in [ ('xxx', xxx), ('yyy', yyy),
+                      ('init_cond', np.asarray( init_cond, dtype=float )) ]:
+        shm, _, specs[key] = _to_shared( np.asarray( arr ) )
+        blocks.append( shm )
+    dtype = np.dtype( dtype )
+    if out_file is None:
+        shm = shared_memory.SharedMemory( create=True, size=max( dtype.itemsize*
+                                          int(np.prod(cube_shape)), 1 ) )
+        specs['cube'] = ( shm.name, cube_shape, dtype.str )
+        blocks.append( shm )
+    else:
+        np.lib.format.open_memmap( out_file, mode='w+', dtype=dtype,
+                                   shape=cube_shape ).flush()
+
+    # Theis arguments common to every timestep
+    kwargs = { 'Q': Q, 'T': aquifer['trans'], 'S': aquifer['stor'],
+               'x_wells': x_wells, 'y_wells': y_wells, 't_stagger': t_stagger,
+               'well_chunk': well_chunk, 'cell_chunk': cell_chunk,
+               'well_fn': well_fn, 'cutoff_tol': cutoff_tol,
+               'schedule': schedule, 'dtype': dtype, 'track_max': track_max }
+    MAX_DD = np.full( ( x_wells.size, t.size ), np.nan )
+
+    try:
+        with ProcessPoolExecutor( max_workers=n_workers, initializer=_attach_shared,
+                                  initargs=(specs,) ) as pool:
+            futures = [ pool.submit( _theis_block_worker,
+                                     np.arange( b0, min( b0 + block_size, t.size ) ),
+                                     t[b0:b0 + block_size], out_file, kwargs )
+                        for b0 in range( 0, t.size, block_size ) ]
+            # collect the per-well maxima in timestep order
+            for future in futures:
+                tti_block, well_maxes = future.result()
+                MAX_DD[:, tti_block] = well_maxes.T
+
+        # copy the cube out of shared memory before releasing it
+        if out_file is None:
+            cube = np.ndarray( cube_shape, dtype=dtype, buffer=blocks[-1].buf ).copy()
+        else:
+            cube = np.load( out_file, mmap_mode='r+' )
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return cube, MAX_DD
+
 
 
 #%% FUNCTION THAT HANDLES ALL OF THE THEIS SOLUTION STEPS
@@ -375,93 +2279,402 @@ def TheisFunc( x, y, Q, T, S, t_time, x_well, y_well):
 # convert gpm to cubic meters per hour (cmh)    
 gpm2cmh = lambda aaa: aaa*60*(ft2m**3)/g2ft3
 
-def TheisModule(aquifer, dtm_array, VeniceWells, xxx, yyy, ttt, t, 
-                MAX_DD, soln_dict, counter2, welldata='nope'):
-    # Loop through wells by their geometries
-    # variable resets
-    RunSum = np.zeros(dtm_array.shape)
-    counter3 = 0
-       
-    # Venice calculations ==========================
-    if type(welldata) == str:
-        for xes, yes in zip( VeniceWells.loc[:,'geometry'].x,
-                             VeniceWells.loc[:,'geometry'].y ):
-            # Calculate Theis at each well and later sum (superimpose) solutions for every well for each timestep
-            if ttt > 0:
-                well_s = TheisFunc( xxx, yyy, aquifer['discharge'], aquifer['trans'], aquifer['stor'], ttt,
-                                 xes, yes )
-            else:
-                # staggering the solution time for pumping and injecting by t[1]
-                ttt2 = t[1] + abs(ttt)
-                # continuing pumping during injecting to simulate recovery
-                well_s = ( ( TheisFunc( xxx, yyy, aquifer['discharge'],
-                                                 aquifer['trans'], aquifer['stor'],
-                                                 ttt2, xes, yes ) ) -
-                                ( TheisFunc( xxx, yyy, aquifer['discharge'],
-                                                  aquifer['trans'], aquifer['stor'],
-                                                  ttt, xes, yes ) ) )
-            # Building MAX_DD to keep track of draw down due to each singular well (target ~ 10 ft)
-            MAX_DD[counter3][counter2]= np.max(well_s)
-            
-            # Running sum of each well's solution (well_s) to superimpose
-            RunSum = RunSum + well_s
-            
-            counter3 = counter3 + 1
-            
-            print ("Done looking at well location: ({:.2f}, {:.2f})".format(xes, yes))
-    # End Venice calculations ===========================
-        
-    # East St. Louis Calculations =======================
+# preallocate MAX_DD -> (wells, timesteps), NaN until filled by TheisModule
+def init_max_dd( n_wells, n_times ):
+    return np.full( ( n_wells, n_times ), np.nan )
+
+# store the maximum drawdown of the active wells (well_max) in column counter2
+# of MAX_DD (an array from init_max_dd or a list of lists) -> NaN for the
+# wells NOT in use
+def _store_max_dd( MAX_DD, wells, counter2, well_max ):
+    if isinstance( MAX_DD, np.ndarray ):
+        MAX_DD[:, counter2]            = np.nan
+        MAX_DD[wells.active, counter2] = well_max
     else:
-        for vwi, xes, yes in zip( range( len(VeniceWells) ), 
-                                  VeniceWells.loc[:,'geometry'].x,
-                                  VeniceWells.loc[:,'geometry'].y ):
-            # determine welldata index (wdi) from well names
-            wellname = VeniceWells.loc[vwi, 'Name']
-            wdi      = np.where( wellname == welldata.loc[:, 'Name'] )[0][0]
-                        
+        for counter3, dd in enumerate( wells.expand( well_max ) ):
+            MAX_DD[counter3][counter2] = dd
+
+# prepared well field -> built once from VeniceWells (and welldata for ESL)
+class WellField:
+
+    # initialization function for class
+    def __init__( self, VeniceWells, welldata='nope', use_col='2019 Oct use +3' ):
+        # contiguous well coordinates from their geometries
+        self.x = np.ascontiguousarray( VeniceWells.loc[:,'geometry'].x, dtype=float )
+        self.y = np.ascontiguousarray( VeniceWells.loc[:,'geometry'].y, dtype=float )
+        self.n_wells = self.x.size
+        if 'Name' in VeniceWells.columns:
+            self.names = np.asarray( VeniceWells.loc[:,'Name'] )
+        else:
+            self.names = np.asarray( [ str(idx) for idx in range( self.n_wells ) ] )
+
+        # Venice -> every well pumps at the aquifer discharge rate
+        if type(welldata) == str:
+            self.area   = 'Venice'
+            self.active = np.ones( self.n_wells, dtype=bool )
+            self.QQQ    = None
+            self.Q      = None
+        # East St. Louis -> well-specific rates of the wells in use in Oct. 2019
+        else:
+            self.area = 'ESL'
+            # determine welldata index (wdi) from well names (first match)
+            name_idx = {}
+            for wdi, wellname in enumerate( welldata.loc[:,'Name'] ):
+                name_idx.setdefault( wellname, wdi )
+            missing = [ wellname for wellname in self.names
+                        if wellname not in name_idx ]
+            if missing:
+                raise Exception( 'Wells {} are not in welldata.'.format( missing ) )
+            wdi = np.asarray( [ name_idx[wellname] for wellname in self.names ],
+                              dtype=int )
             # establish variables - if well in use in Oct. 2019
-            if welldata.loc[wdi, '2019 Oct use +3'] == '1':
-                # define well-specific discharge rate
-                aquifer['discharge'] = gpm2cmh( welldata.loc[wdi, 'QQQ'] )
-                
-                # Calculate Theis at each well and later sum (superimpose) solutions for every well for each timestep
-                if ttt > 0:
-                    well_s = TheisFunc( xxx, yyy, aquifer['discharge'], 
-                                                aquifer['trans'], aquifer['stor'], 
-                                                ttt, xes, yes )
-                else:
-                    # staggering the solution time for pumping and injecting by t[1]
-                    ttt2 = t[1] + abs(ttt)
-                    # continuing pumping during injecting to simulate recovery
-                    well_s = ( ( TheisFunc( xxx, yyy, aquifer['discharge'],
-                                                     aquifer['trans'], aquifer['stor'],
-                                                     ttt2, xes, yes ) ) -
-                                    ( TheisFunc( xxx, yyy, aquifer['discharge'],
-                                                      aquifer['trans'], aquifer['stor'],
-                                                      ttt, xes, yes ) ) )
-                # Building MAX_DD to keep track of draw down due to each singular well (target ~ 10 ft)
-                MAX_DD[counter3][counter2]= np.max(well_s)
-                # Running sum of each well's solution to superimpose
-                RunSum = RunSum + well_s
-                print( ("Done looking at well #{}, location: ({:.2f}, {:.2f})\n"+
-                        'Discharge rate = {:.1f} gpm \n').format(vwi, xes, yes,
-                                          welldata.loc[wdi, 'QQQ']) )
-            # well NOT in use in Oct. 2019
-            else:
-                # Building MAX_DD to keep track of draw down due to each singular well (target ~ 10 ft)
-                MAX_DD[counter3][counter2]= np.nan
-                
-            # update row counter
-            counter3 = counter3 + 1
-                
-    # End East St. Louis calculations ==================
+            self.active = np.asarray( welldata.loc[:,use_col] )[wdi] == '1'
+            # only the rates of the wells in use are read (others may be blank)
+            self.QQQ    = np.zeros( self.n_wells )
+            self.QQQ[self.active] = np.asarray( np.asarray(
+                                        welldata.loc[:,'QQQ'], dtype=object
+                                        )[wdi[self.active]], dtype=float )
+            # well-specific discharge rate (cmh)
+            self.Q      = gpm2cmh( self.QQQ )
+
+        # contiguous coordinates of the active wells
+        self.x_active = np.ascontiguousarray( self.x[self.active] )
+        self.y_active = np.ascontiguousarray( self.y[self.active] )
+
+    # discharge rate of each active well (cmh)
+    def active_rates( self, aquifer ):
+        if self.Q is None:
+            return np.full( self.x_active.size, aquifer['discharge'], dtype=float )
+        return self.Q[self.active]
+
+    # keyword arguments of the active wells for TheisCube/TheisParallel
+    def theis_args( self, aquifer ):
+        return { 'x_wells': self.x_active, 'y_wells': self.y_active,
+                 'Q': self.active_rates( aquifer ) }
+
+    # expand rows of the active wells to every well (NaN for wells NOT in use)
+    def expand( self, active_rows ):
+        active_rows = np.asarray( active_rows )
+        full = np.full( ( self.n_wells, ) + active_rows.shape[1:], np.nan )
+        full[self.active] = active_rows
+        return full
+
+    def __len__( self ):
+        return self.n_wells
+#===============================
+
+
 
+# VeniceWells may be a GeoDataFrame (with welldata for ESL) or a WellField;
+# a prepared WellField skips all of the pandas lookups in each timestep
+def TheisModule(aquifer, dtm_array, VeniceWells, xxx, yyy, ttt, t, 
+                MAX_DD, soln_dict, counter2, welldata='nope',
+                well_chunk=16, cell_chunk=65536, dist_cache=None,
+                well_fn='exact', cutoff_tol=None, dtype=np.float64, out=None,
+                track_max='auto', verbose=False):
+    # prepare the well field (if not already)
+    if isinstance( VeniceWells, WellField ):
+        wells = VeniceWells
+    else:
+        wells = WellField( VeniceWells, welldata )
+        # previous versions left the last active ESL rate in the aquifer
+        if wells.area == 'ESL' and np.any( wells.active ):
+            aquifer['discharge'] = wells.Q[wells.active][-1]
+    # staggering time (t[1]) only needed for recovery timesteps
+    t_stagger = t[1] if ttt <= 0 else None
+
+    # reuse the well-to-grid distances from previous timesteps, if cached
+    r2 = None
+    if dist_cache is not None:
+        r2 = dist_cache.get( xxx, yyy, wells.x_active, wells.y_active,
+                             dtype=dtype )
+
+    # Calculate Theis for all (active) wells at once and sum (superimpose) solutions
+    RunSum, well_max = TheisSuperposition( xxx, yyy, wells.active_rates( aquifer ),
+                                           aquifer['trans'], aquifer['stor'], ttt,
+                                           wells.x_active, wells.y_active,
+                                           t_stagger=t_stagger,
+                                           well_chunk=well_chunk,
+                                           cell_chunk=cell_chunk, r2=r2,
+                                           well_fn=well_fn,
+                                           cutoff_tol=cutoff_tol, dtype=dtype,
+                                           out=out, track_max=track_max )
+    RunSum = RunSum.reshape( dtm_array.shape )
+
+    # Building MAX_DD to keep track of draw down due to each singular well (target ~ 10 ft)
+    # -> NaN for wells NOT in use in Oct. 2019
+    _store_max_dd( MAX_DD, wells, counter2, well_max )
+
+    # update user
+    if verbose:
+        print( 'Done with {} of {} wells at time {:.2f} hr(s).'.format(
+                wells.x_active.size, wells.n_wells, ttt ) )
 
     # return the difference between drawdown or residual drawdown and the initial condition
-    return soln_dict['init_cond'] - RunSum
+    # -> computed in place within the (preallocated) RunSum buffer
+    return np.subtract( soln_dict['init_cond'], RunSum, out=RunSum )
+
+#%% THEIS SOLUTION RESTRICTED TO THE POLYGON CELLS
+
+# union of the polygon cell masks (from find_cells_within_polygon)
+def polygon_union_mask( poly_masks ):
+    union = None
+    for mask in poly_masks:
+        union = np.array( mask, dtype=bool ) if union is None else union | mask
+    if union is None:
+        raise Exception('No polygon cell masks were provided.')
+    return union
+#===============================
+
+
+
+# water table for the risk computation -> superposed drawdown evaluated only on
+# the cells of cell_mask (NaN elsewhere) and, optionally, on a coarse preview
+# grid of every preview_stride-th row and column; same arguments as TheisModule
+def TheisRiskCells( aquifer, dtm_array, VeniceWells, xxx, yyy, ttt, t, MAX_DD,
+                    soln_dict, counter2, cell_mask, welldata='nope',
+                    preview_stride=None, well_chunk=16, cell_chunk=65536,
+                    dist_cache=None, well_fn='exact', dtype=np.float64, out=None ):
+    # prepare the well field (if not already)
+    if isinstance( VeniceWells, WellField ):
+        wells = VeniceWells
+    else:
+        wells = WellField( VeniceWells, welldata )
+    Q = wells.active_rates( aquifer )
+    T, S = aquifer['trans'], aquifer['stor']
+    t_stagger = t[1] if ttt <= 0 else None
+    init_cond = np.asarray( soln_dict['init_cond'] )
+
+    # coordinates of the polygon cells only
+    cells = np.flatnonzero( cell_mask )
+    x_cells = np.asarray( xxx ).reshape(-1)[cells]
+    y_cells = np.asarray( yyy ).reshape(-1)[cells]
+    r2 = None
+    if dist_cache is not None:
+        r2 = dist_cache.get( x_cells, y_cells, wells.x_active, wells.y_active,
+                             dtype=dtype )
+
+    # superposed drawdown on the polygon cells
+    RunSum, _ = TheisSuperposition( x_cells, y_cells, Q, T, S, ttt,
+                                    wells.x_active, wells.y_active,
+                                    t_stagger=t_stagger, well_chunk=well_chunk,
+                                    cell_chunk=cell_chunk, r2=r2, well_fn=well_fn,
+                                    dtype=dtype, track_max=None )
+    # water table on the polygon cells, NaN elsewhere
+    if out is None:
+        out = np.empty( dtm_array.shape, dtype=dtype )
+    out[...] = np.nan
+    if init_cond.ndim == 0:
+        out.reshape(-1)[cells] = init_cond - RunSum
+    else:
+        out.reshape(-1)[cells] = init_cond.reshape(-1)[cells] - RunSum
+
+    # maximum drawdown of each well still refers to the full grid
+    # -> injection (any rate < 0) does not peak next to the well: every cell
+    if np.any( Q < 0 ):
+        _, well_max = TheisSuperposition( xxx, yyy, Q, T, S, ttt,
+                                          wells.x_active, wells.y_active,
+                                          t_stagger=t_stagger,
+                                          well_chunk=well_chunk,
+                                          cell_chunk=cell_chunk, well_fn=well_fn,
+                                          dtype=dtype, track_max='grid' )
+    else:
+        elapsed, rates = theis_well_terms( Q, ttt, t_stagger )
+        well_max = theis_nearest_max( xxx, yyy, wells.x_active, wells.y_active,
+                                      elapsed, rates, T, S, well_fn=well_fn,
+                                      dtype=dtype )
+    _store_max_dd( MAX_DD, wells, counter2, well_max )
+
+    # coarse preview of the whole grid
+    preview = None
+    if preview_stride is not None:
+        x_prev = np.asarray( xxx )[::preview_stride, ::preview_stride]
+        y_prev = np.asarray( yyy )[::preview_stride, ::preview_stride]
+        RunSum, _ = TheisSuperposition( x_prev, y_prev, Q, T, S, ttt,
+                                        wells.x_active, wells.y_active,
+                                        t_stagger=t_stagger,
+                                        well_chunk=well_chunk,
+                                        cell_chunk=cell_chunk, well_fn=well_fn,
+                                        dtype=dtype, track_max=None )
+        if init_cond.ndim == 0:
+            preview = np.subtract( init_cond, RunSum, out=RunSum )
+        else:
+            preview = np.subtract( init_cond[::preview_stride, ::preview_stride],
+                                   RunSum, out=RunSum )
+
+    return out, preview
+
+
+
+#%% TIME TO EXCEEDANCE OF EACH POLYGON
+
+# order of the risk levels (columns) -> same as the risk codes
+RISK_LEVELS = ( 'surface', 'basement', 'infrastructure' )
+
+# water table at a set of cells at time tau (hrs since pumping started)
+def _cells_water_table( tau, x_cells, y_cells, init_cells, T, S, xw, yw,
+                        schedule, well_fn='exact', dtype=np.float64 ):
+    RunSum, _ = TheisSuperposition( x_cells, y_cells, 0.0, T, S, tau, xw, yw,
+                                    schedule=schedule, well_fn=well_fn,
+                                    dtype=dtype, track_max=None )
+    return init_cells - RunSum
+#===============================
+
+
+
+# first time each polygon's water table percentile crosses each of its
+# risk_threshold_table levels, going down ('clear', the level is no longer
+# exceeded) and going up ('onset', the level becomes exceeded)
+# -> times in hrs since pumping started; constant rate pumping for t_pump hrs
+#    then recovery (TheisModule's recovery timestep t is t_pump + |t|), or any
+#    pumping schedule (see pumping_schedule)
+# -> the crossings are bracketed on n_bracket log-spaced times within each
+#    constant-rate period (drawdown is monotonic within them), then located to
+#    xtol hrs by root-finding on the cells of the polygon only
+# -> returns 'initial' (exceeded before pumping), 'clear' and 'onset' as
+#    (n_polygons, 3) arrays, columns in RISK_LEVELS order (NaN: no crossing
+#    before t_end, or a level that does not apply to the polygon), and the
+#    bracketing 'times'
+def time_to_exceedance( table, aquifer, xxx, yyy, init_cond, x_wells, y_wells,
+                        t_end, Q=None, t_pump=None, schedule=None, n_bracket=32,
+                        xtol=1e-3, well_fn='exact', dtype=np.float64 ):
+    poly_cells = table['poly_cells']
+    T, S = aquifer['trans'], aquifer['stor']
+    xw = np.asarray( x_wells, dtype=float ).reshape(-1)
+    yw = np.asarray( y_wells, dtype=float ).reshape(-1)
+    if schedule is None:
+        if t_pump is None:
+            raise Exception('A pumping duration (t_pump) or a pumping '+
+                            'schedule is required.')
+        schedule = constant_rate_schedule( aquifer['discharge'] if Q is None
+                                           else Q, t_pump, n_wells=xw.size )
+
+    # every cell of any polygon, evaluated once per bracketing time
+    cells, inverse = np.unique( poly_cells.cell_index, return_inverse=True )
+    x_cells = np.asarray( xxx ).reshape(-1)[cells]
+    y_cells = np.asarray( yyy ).reshape(-1)[cells]
+    init_cond = np.asarray( init_cond )
+    init_cells = init_cond if init_cond.ndim == 0 else \
+                 init_cond.reshape(-1)[cells]
+    levels = np.stack( [ table[level] for level in RISK_LEVELS ], axis=1 )
+
+    # bracketing times: log-spaced within each constant-rate period
+    changes = np.unique( schedule['t_on'][ np.isfinite( schedule['t_on'] ) ] )
+    bounds  = np.unique( np.r_[ 0.0, changes[ (changes > 0) & (changes < t_end) ],
+                                t_end ] )
+    times = [ 0.0 ]
+    for a, b in zip( bounds[:-1], bounds[1:] ):
+        times.extend( a + ( b - a )*np.geomspace( 1e-4, 1.0, n_bracket ) )
+    times = np.unique( times )
+
+    # water table percentile of every polygon at the bracketing times
+    wt_elev = np.empty( ( times.size, len(poly_cells) ) )
+    for ti, tau in enumerate( times ):
+        wt_cells = _cells_water_table( tau, x_cells, y_cells, init_cells, T, S,
+                                       xw, yw, schedule, well_fn, dtype )
+        wt_elev[ti] = grouped_percentile( wt_cells[inverse], poly_cells.offsets,
+                                          table['percent'] )
+
+    # root-finding on the cells of a single polygon
+    def excess( tau, idx, level ):
+        cell_sel = inverse[ poly_cells.offsets[idx]:poly_cells.offsets[idx+1] ]
+        wt_cells = _cells_water_table( tau, x_cells[cell_sel], y_cells[cell_sel],
+                                       init_cells if init_cells.ndim == 0
+                                       else init_cells[cell_sel],
+                                       T, S, xw, yw, schedule, well_fn, dtype )
+        return np.percentile( wt_cells, float( table['percent'][idx] ) ) - \
+               levels[idx, level]
+
+    initial = wt_elev[0][:,np.newaxis] >= levels
+    crossing = { 'clear': np.full( levels.shape, np.nan ),
+                 'onset': np.full( levels.shape, np.nan ) }
+    for idx, level in zip( *np.nonzero( np.isfinite( levels ) ) ):
+        exceeded = wt_elev[:,idx] >= levels[idx, level]
+        for name, before, after in ( ('clear', True, False),
+                                     ('onset', False, True) ):
+            hit = np.flatnonzero( ( exceeded[:-1] == before ) &
+                                  ( exceeded[1:] == after ) )
+            if hit.size == 0:
+                continue
+            lo, hi = times[hit[0]], times[hit[0] + 1]
+            crossing[name][idx, level] = spo.brentq( excess, lo, hi,
+                                                     args=( idx, level ),
+                                                     xtol=xtol )
+
+    return { 'initial': initial, 'clear': crossing['clear'],
+             'onset': crossing['onset'], 'times': times }
+
+
+
+#%% CHECK THE RISK CLASSIFICATIONS BETWEEN PRECISIONS
+
+# run the drawdown and risk pipeline in float64 and float32 (in preallocated
+# buffers) and compare the 'PlotColors' of every polygon at every timestep
+def compare_precision_classifications( aquifer, dtm_array, VeniceWells, xxx, yyy,
+                                       t, soln_dict, polygon_df, poly_masks,
+                                       grd_surface, welldata='nope',
+                                       percent_threshold=25, area='Venice',
+                                       esl_sites=[], **theis_kwargs ):
+    precisions = ( np.float64, np.float32 )
+    # prepare the well field once
+    if not isinstance( VeniceWells, WellField ):
+        VeniceWells = WellField( VeniceWells, welldata )
+    # preallocated water table buffers and MAX_DD for each precision
+    buffers = { dtype: np.empty( dtm_array.shape, dtype=dtype )
+                for dtype in precisions }
+    MAX_DD  = { dtype: init_max_dd( len(VeniceWells), len(t) )
+                for dtype in precisions }
+    mismatches = []
+    max_diff   = 0.0
+
+    # loop through the timesteps
+    for counter2, ttt in enumerate( t ):
+        colors = {}
+        for dtype in precisions:
+            water_table = TheisModule( dict(aquifer), dtm_array, VeniceWells,
+                                       xxx, yyy, ttt, t, MAX_DD[dtype],
+                                       soln_dict, counter2,
+                                       dtype=dtype, out=buffers[dtype],
+                                       **theis_kwargs )
+            # classify each polygon
+            colors[dtype] = []
+            for idx in range( len(polygon_df) ):
+                polygon = riskType_threshold( polygon_df.loc[idx].copy(),
+                                              poly_masks[idx], water_table,
+                                              grd_surface, percent_threshold,
+                                              area, esl_sites )
+                colors[dtype].append( polygon.get( 'PlotColors', np.nan ) )
+
+        # compare the water tables and the classifications
+        max_diff = max( max_diff, float( np.nanmax( np.abs(
+                        buffers[np.float64] - buffers[np.float32] ) ) ) )
+        for idx, (c64, c32) in enumerate( zip( colors[np.float64],
+                                               colors[np.float32] ) ):
+            if not ( c64 == c32 or ( c64 != c64 and c32 != c32 ) ):
+                mismatches.append( ( counter2, idx ) )
+
+    # update user
+    print( ('Precision check: {} timesteps x {} polygons, {} classification '+
+            'mismatches, max. water table difference = {:.2e} ft').format(
+                    len(t), len(polygon_df), len(mismatches), max_diff ) )
+
+    return { 'mismatches': mismatches, 'max_abs_diff': max_diff }
+
+
 
 #%% BEHOLD: THE CONVERSION FACTORS
 ft2m = 0.304800609601219
 m2ft = 1/ft2m
-g2ft3 = 7.48051948
\ No newline at end of file
+g2ft3 = 7.48051948
+
+
+
+#%% RUNNING THE FILE AS A WHOLE
+if __name__ == "__main__":
+
+    # benchmark the well function modes
+    benchmark_well_function()
+    # benchmark the polygon rasterization
+    benchmark_find_cells_within_polygon()
+    # check the distance cache releases its spilled sets safely
+    check_distance_cache_release()
@@ -7,12 +7,16 @@ Created on Wed Feb  5 11:57:40 2020
 
 #%% IMPORTS
 import os
+import io
+import csv
 import pandas as pd
 import numpy as np
 
 #%% universal functions??
 
 # public - method to read data from tab-separated USGS file
+# -> columnar: the file is read once, the data lines parsed by pandas as text,
+#    and each column converted as a whole (float, datetime, or text)
 def read_tab_separated_USGS(filename=None, filepath=None):
     #!!! Expansion: allow user to specify a file to read here...
     if filename is None:
@@ -20,41 +24,40 @@ def read_tab_separated_USGS(filename=None, filepath=None):
     # assumes current working directory if no filepath specified
     if filepath is None:
         filepath = os.getcwd()
+    
+    # open text file and read in the data (a single read)
+    with open( os.path.join(filepath, filename), 'r') as fid:
+        lines = fid.read().splitlines()
+
+    # usgs documentation ('#' lines) -> variables being presented
+    usgsdoc = [ line for line in lines if '#' in line ]
+    # grab the column headers (last header line, as previous versions did) and
+    # the data lines that follow it -> skips the RDB format line ('5s 15s ...')
+    coltitles = None
+    body = []
+    for line in lines:
+        if '#' not in line and 'agency_cd' in line:
+            coltitles = line.split('\t')
+            body = []
+        elif line.startswith('USGS\t') or line == 'USGS':
+            body.append( line )
+    if coltitles is None:
+        raise Exception('AEJ: No column headers ("agency_cd") were found in '+
+                        '{}.'.format( filename ))
+
+    # parse every data line at once, as text
+    table = pd.read_csv( io.StringIO( '\n'.join( body ) ), sep='\t',
+                         header=None, names=coltitles, dtype=str,
+                         na_filter=False, quoting=csv.QUOTE_NONE,
+                         engine='c' ) if body else \
+            pd.DataFrame( { title: pd.Series( [], dtype=str )
+                            for title in coltitles } )
+    
     #create a dictionary for storage, eventual conversion to pd.df
     data = {}
-    usgsdoc = []
-    
-    # open text file and read in the data
-    with open( os.path.join(filepath, filename), 'r+') as fid:
-        # read through the each line
-        for line in fid.readlines():
-            # removing the break line character ('\n') from analysis
-            line = line[:-1]
-            # determine variables being presented
-            if '#' in line:
-                usgsdoc.append(line)                
-            # grab the column headers (dictionary keys) 
-            if '#' not in line and 'agency_cd' in line:
-                # create dictionary headers
-                coltitles = line.split('\t')
-                for title in coltitles:
-                    data[title] = [] # create empty list to which to append data
-            
-            # determine if line contains data
-            elif 'USGS' == line.split('\t')[0]:
-                for iii, info in enumerate(line.split('\t')):
-                    # append 'nan' values if no data
-                    if info == '':
-                        data[ coltitles[iii] ].append(np.nan)
-                    # convert to float or datetime depending upon which data is being grabbed
-                    elif info[0].isnumeric() and '-' not in info:
-                        data[ coltitles[iii] ].append( np.float(info) )
-                    elif info[0].isnumeric() and '-' in info:
-                        data[ coltitles[iii] ].append( pd.to_datetime(info, format='%Y-%m-%d %H:%M') )
-                    else:
-                        data[ coltitles[iii] ].append(info)
+    for title in coltitles:
+        data[title] = __convert_USGS_column( table[title].fillna('') )
                     
-    #---------- CLOSE TXT FILE
     # review usgs documentation info and determine valuable column header info
     replace= __parse_USGS_parameters( usgsdoc )
     
@@ -64,6 +67,48 @@ def read_tab_separated_USGS(filename=None, filepath=None):
         
     # return the DataFrame returned by dictionary
     return pd.DataFrame( data )
+
+
+
+# **private** - method converts a column of text values as a whole:
+#   '' -> NaN, numeric without '-' -> float, numeric with '-' -> datetime,
+#   anything else -> text (mixed columns keep each kind, as object)
+def __convert_USGS_column( column ):
+    values = column.to_numpy( dtype=object )
+    empty  = column == ''
+    first  = column.str[:1]
+    isnum  = first.str.isnumeric() & ~empty
+    dashed = column.str.contains('-', regex=False)
+    num_cells = ( isnum & ~dashed ).to_numpy()
+    dt_cells  = ( isnum & dashed ).to_numpy()
+    txt_cells = ( ~isnum & ~empty ).to_numpy()
+
+    # convert to float or datetime depending upon which data is being grabbed
+    if not np.any( dt_cells ) and not np.any( txt_cells ):
+        return pd.to_numeric( column.where( ~empty ) ).astype( float ).to_numpy()
+    if not np.any( num_cells ) and not np.any( txt_cells ):
+        return __to_datetime_USGS( column.where( ~empty ) )
+    if not np.any( num_cells ) and not np.any( dt_cells ):
+        return column.where( ~empty, np.nan ).to_numpy( dtype=object )
+
+    # mixed column -> convert each kind of value separately
+    out = np.full( values.size, np.nan, dtype=object )
+    out[txt_cells] = values[txt_cells]
+    if np.any( num_cells ):
+        out[num_cells] = list( pd.to_numeric( column[num_cells] ).astype( float ) )
+    if np.any( dt_cells ):
+        out[dt_cells] = list( __to_datetime_USGS( column[dt_cells] ) )
+    return out
+
+
+
+# **private** - method converts a column of USGS date/times ('%Y-%m-%d %H:%M';
+# other layouts, e.g. daily values, are left to pandas to determine)
+def __to_datetime_USGS( column ):
+    try:
+        return pd.to_datetime( column, format='%Y-%m-%d %H:%M' )
+    except ValueError:
+        return pd.to_datetime( column )
   
 
       